@@ -1,9 +1,17 @@
-from .hcp_utils import struct, vertex_info, mesh
+from .hcp_utils import struct, vertex_info, voxel_info, mesh
 from .hcp_utils import standard, mmp, ca_network, ca_parcels, yeo7, yeo17
 from .hcp_utils import view_parcellation, parcellation_labels, make_lr_parcellation
-from .hcp_utils import parcellate, unparcellate, mask, ranking, normalize
-from .hcp_utils import left_cortex_data, right_cortex_data, cortex_data, combine_meshes, load_surfaces
-from .hcp_utils import get_HCP_vertex_info
+from .hcp_utils import parcellation_hierarchy, aggregate_parcels, aggregate_connectivity
+from .hcp_utils import parcellation_overlap, parcel_composition, parcellation_similarity
+from .hcp_utils import parcellate, unparcellate, mask, ranking, normalize, structure_statistics
+from .hcp_utils import left_cortex_data, right_cortex_data, cortex_data, combine_meshes, load_surfaces, SurfaceMeshes
+from .hcp_utils import get_HCP_vertex_info, get_HCP_voxel_info, get_HCP_struct, vertex_areas, grayordinate_areas, parcel_geometry
 from .hcp_utils import cortical_adjacency, cortical_components
+from .hcp_utils import subcortical_adjacency, whole_brain_adjacency, whole_brain_components
+from .hcp_utils import local_maxima, watershed_parcellation
+from .glm import glm, glm_design
+from .render import render_maps, prepare_rendering
+from .connectivity import sliding_window_connectivity, unpack_connectivity
+from . import profiling, parallel
 
 __version__ = '0.1.0'
@@ -0,0 +1,287 @@
+"""
+Benchmarks of the main functions of hcp_utils on synthetic data of realistic HCP size.
+
+Run with
+
+```
+python -m hcp_utils.bench --timepoints 1200 --save baseline.json
+python -m hcp_utils.bench --timepoints 1200 --compare baseline.json
+```
+
+Each benchmark runs in a forked child process, so that its peak resident memory can be measured separately.
+Recorded are the best wall time over `--repeat` runs, the peak RSS of the process (including the input data)
+and the peak of memory allocated during a single call (traced with `tracemalloc`).
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+PARCELLATIONS = ['standard', 'mmp', 'ca_network', 'ca_parcels', 'yeo7', 'yeo17']
+
+N_GRAYORDINATES = 91282
+
+
+def _timeseries(n_timepoints, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.standard_normal((n_timepoints, N_GRAYORDINATES), dtype=np.float32)
+
+
+def _benchmarks():
+    """
+    Returns a dictionary name: setup, where setup(n_timepoints) prepares the input data
+    and returns the function to be timed.
+    """
+    import hcp_utils as hcp
+
+    benchmarks = dict()
+
+    for name in PARCELLATIONS:
+        def setup_parcellate(n_timepoints, name=name):
+            X = _timeseries(n_timepoints)
+            parcellation = hcp.hcp_utils._load_hcp_parcellation(name)
+            return lambda: hcp.parcellate(X, parcellation)
+
+        def setup_unparcellate(n_timepoints, name=name):
+            parcellation = hcp.hcp_utils._load_hcp_parcellation(name)
+            Xp = _timeseries(n_timepoints)[:, :len(parcellation.nontrivial_ids)].copy()
+            return lambda: hcp.unparcellate(Xp, parcellation)
+
+        def setup_make_lr(n_timepoints, name=name):
+            parcellation = hcp.hcp_utils._load_hcp_parcellation(name)
+            return lambda: hcp.make_lr_parcellation(parcellation)
+
+        def setup_parcellate_chunked(n_timepoints, name=name):
+            X = _timeseries(n_timepoints)
+            parcellation = hcp.hcp_utils._load_hcp_parcellation(name)
+            return lambda: hcp.parcellate(X, parcellation, n_jobs=-1, chunk_size=64)
+
+        benchmarks['parcellate[{}]'.format(name)] = setup_parcellate
+        benchmarks['parcellate[{},n_jobs=-1]'.format(name)] = setup_parcellate_chunked
+        benchmarks['unparcellate[{}]'.format(name)] = setup_unparcellate
+        benchmarks['make_lr_parcellation[{}]'.format(name)] = setup_make_lr
+
+    def setup_normalize(n_timepoints):
+        X = _timeseries(n_timepoints)
+        return lambda: hcp.normalize(X)
+
+    def setup_normalize_chunked(n_timepoints):
+        X = _timeseries(n_timepoints)
+        return lambda: hcp.normalize(X, n_jobs=-1)
+
+    def setup_cortex_data(n_timepoints):
+        X = _timeseries(n_timepoints)
+        return lambda: [hcp.cortex_data(x) for x in X]
+
+    def setup_cortical_components(n_timepoints):
+        condition = _timeseries(1)[0] > 1.0
+        return lambda: hcp.cortical_components(condition)
+
+    def setup_watershed(n_timepoints):
+        maps = _timeseries(min(n_timepoints, 100))
+        return lambda: hcp.watershed_parcellation(maps, threshold=1.0, min_distance=2)
+
+    def setup_load_surfaces(n_timepoints):
+        return lambda: hcp.load_surfaces(lazy=False)
+
+    def setup_load_inflated(n_timepoints):
+        return lambda: hcp.load_surfaces(variants=['inflated']).inflated
+
+    benchmarks['normalize'] = setup_normalize
+    benchmarks['normalize[n_jobs=-1]'] = setup_normalize_chunked
+    benchmarks['cortex_data'] = setup_cortex_data
+    benchmarks['cortical_components'] = setup_cortical_components
+    benchmarks['watershed_parcellation'] = setup_watershed
+    benchmarks['load_surfaces'] = setup_load_surfaces
+    benchmarks['load_surfaces[inflated]'] = setup_load_inflated
+    return benchmarks
+
+
+def _run_in_child(name, n_timepoints, repeat, conn):
+    setup = _benchmarks()[name]
+    fn = setup(n_timepoints)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    fn()
+    _, allocated = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    conn.send({'time': min(times), 'peak_rss': peak_rss, 'allocated': allocated})
+    conn.close()
+
+
+def run_benchmark(name, n_timepoints=1200, repeat=3):
+    """
+    Runs a single benchmark in a forked process and returns its measurements.
+    Raises RuntimeError if the process fails (e.g. raises an exception or is killed when out of memory).
+    """
+    ctx = multiprocessing.get_context('fork')
+    parent, child = ctx.Pipe(duplex=False)
+    p = ctx.Process(target=_run_in_child, args=(name, n_timepoints, repeat, child))
+    p.start()
+    # without the parent's copy of the child end, recv() sees EOF when the child dies
+    child.close()
+    try:
+        result = parent.recv()
+    except EOFError:
+        result = None
+    finally:
+        parent.close()
+        p.join()
+    if result is None or p.exitcode != 0:
+        raise RuntimeError('benchmark {} failed with exit code {}'.format(name, p.exitcode))
+    return result
+
+
+def _spawn(args):
+    # fork and exec directly, so that wait4 reaps the process and reports its own resource usage
+    pid = os.fork()
+    if pid == 0:
+        try:
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, 1)
+            os.dup2(devnull, 2)
+            os.execv(args[0], args)
+        finally:
+            os._exit(127)
+    return pid
+
+
+def run_import_benchmark(repeat=3):
+    """
+    Measures the time and peak memory of `import hcp_utils` in a fresh interpreter.
+    """
+    times = []
+    peak_rss = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        pid = _spawn([sys.executable, '-c', 'import hcp_utils'])
+        _, status, rusage = os.wait4(pid, 0)
+        times.append(time.perf_counter() - start)
+        peak_rss = max(peak_rss, rusage.ru_maxrss * 1024)
+        if not os.WIFEXITED(status) or os.WEXITSTATUS(status) != 0:
+            code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            raise RuntimeError('import hcp_utils failed with exit code {}'.format(code))
+    return {'time': min(times), 'peak_rss': peak_rss, 'allocated': None}
+
+
+def run(names=None, n_timepoints=1200, repeat=3, verbose=True):
+    """
+    Runs the benchmarks whose names contain one of the strings in `names` (all by default).
+    Returns a dictionary name: measurements (or `{'error': message}` for a failed benchmark).
+    """
+    all_names = ['import hcp_utils'] + list(_benchmarks())
+    if names:
+        all_names = [n for n in all_names if any(s in n for s in names)]
+
+    results = dict()
+    for name in all_names:
+        try:
+            if name == 'import hcp_utils':
+                results[name] = run_import_benchmark(repeat)
+            else:
+                results[name] = run_benchmark(name, n_timepoints, repeat)
+        except RuntimeError as e:
+            results[name] = {'error': str(e)}
+        if verbose:
+            print(_format_row(name, results[name]), flush=True)
+    return results
+
+
+def _mb(n):
+    return '-' if n is None else '{:.1f}'.format(n / 2**20)
+
+
+# allocations growing by less than this are not reported, whatever the relative change
+MEMORY_SLACK = 2**20
+
+
+def _format_row(name, r, baseline=None):
+    if 'error' in r:
+        return '{:40s} FAILED: {}'.format(name, r['error'])
+    row = '{:40s} {:10.4f} {:>12s} {:>14s}'.format(name, r['time'], _mb(r['peak_rss']), _mb(r['allocated']))
+    if baseline is not None and 'error' not in baseline:
+        row += ' {:8.2f}x'.format(r['time'] / baseline['time'])
+        if r['allocated'] is not None and baseline['allocated']:
+            row += ' {:8.2f}x'.format(r['allocated'] / baseline['allocated'])
+        else:
+            row += ' {:>9s}'.format('-')
+    return row
+
+
+def compare(results, baseline, tolerance=0.2, memory_tolerance=0.2):
+    """
+    Compares the results with the baseline ones. Returns the names of benchmarks which are slower
+    by more than the relative `tolerance`, allocate more memory than the relative `memory_tolerance`
+    (and at least `MEMORY_SLACK` bytes more) or which failed.
+    The peak RSS is shown but not compared, as it is dominated by the memory of the parent process.
+    """
+    print()
+    print('{:40s} {:>10s} {:>12s} {:>14s} {:>9s} {:>9s}'.format('benchmark', 'time [s]', 'peak RSS [MB]', 'allocated [MB]',
+                                                              'time', 'memory'))
+    regressions = []
+    for name, r in results.items():
+        b = baseline.get(name)
+        row = _format_row(name, r, b)
+        if 'error' in r:
+            regressions.append(name)
+        elif b is not None and 'error' not in b:
+            slower = r['time'] > b['time'] * (1 + tolerance)
+            larger = (r['allocated'] is not None and b['allocated'] is not None
+                      and r['allocated'] > b['allocated'] * (1 + memory_tolerance) + MEMORY_SLACK)
+            if slower or larger:
+                regressions.append(name)
+                row += '  REGRESSION ({})'.format(', '.join(k for k, v in (('time', slower), ('memory', larger)) if v))
+        print(row)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m hcp_utils.bench', description='Benchmarks of hcp_utils.')
+    parser.add_argument('names', nargs='*', help='run only benchmarks containing one of these strings')
+    parser.add_argument('--timepoints', type=int, default=1200, help='number of time frames of the synthetic data')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs of each benchmark')
+    parser.add_argument('--save', help='save the results as JSON to this file')
+    parser.add_argument('--compare', help='compare with the results saved in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative slowdown reported as a regression')
+    parser.add_argument('--memory-tolerance', type=float, default=0.2,
+                        help='relative increase of the allocated memory reported as a regression')
+    args = parser.parse_args(argv)
+
+    print('{:40s} {:>10s} {:>12s} {:>14s}'.format('benchmark', 'time [s]', 'peak RSS [MB]', 'allocated [MB]'))
+    results = run(args.names, args.timepoints, args.repeat)
+    failures = [name for name, r in results.items() if 'error' in r]
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'timepoints': args.timepoints, 'results': results}, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('timepoints') != args.timepoints:
+            print('Warning: baseline was recorded with {} time frames'.format(baseline.get('timepoints')))
+        regressions = compare(results, baseline['results'], args.tolerance, args.memory_tolerance)
+        if regressions:
+            print('{} regression(s)'.format(len(regressions)))
+            return 1
+    if failures:
+        print('{} benchmark(s) failed'.format(len(failures)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,155 @@
+import numpy as np
+
+from .profiling import instrumented
+
+# Sliding-window (dynamic) functional connectivity of parcellated time series.
+#
+# For a rectangular or exponentially tapered window the running sums and cross-products
+# are updated incrementally: the incoming frames are added and the outgoing ones removed,
+# which costs O(step K^2) per window instead of O(window K^2).
+# The correlation matrices are returned as their upper triangles (np.triu_indices(K, 1) order).
+
+# number of incremental updates after which the running sums are recomputed from scratch
+# to keep the accumulated rounding errors in check
+_REFRESH = 256
+
+
+def _window_moments(Xp, window, step, taper, tau):
+    """
+    Yields for each window position the total weight, the weighted sum and the weighted cross-product matrix.
+    """
+    T = len(Xp)
+    starts = range(0, T - window + 1, step)
+
+    if taper is None or (isinstance(taper, str) and taper == 'boxcar'):
+        w_total = float(window)
+        S1 = S2 = None
+        updates = 0
+        for start in starts:
+            stop = start + window
+            if S1 is None or step >= window or updates >= _REFRESH:
+                A = Xp[start:stop]
+                S1 = A.sum(axis=0)
+                S2 = A.T @ A
+                updates = 0
+            else:
+                A = Xp[stop - step:stop]
+                R = Xp[start - step:start]
+                S1 += A.sum(axis=0) - R.sum(axis=0)
+                S2 += A.T @ A - R.T @ R
+                updates += 1
+            yield w_total, S1, S2
+
+    elif isinstance(taper, str):
+        # weight lam**(window-1-i) of the i-th frame of the window, the newest one has weight 1
+        lam = np.exp(-1.0 / tau)
+        w = lam ** np.arange(window - 1, -1, -1)
+        w_total = w.sum()
+        lam_w = lam ** window
+        S1 = S2 = None
+        updates = 0
+        for start in starts:
+            stop = start + window
+            if S1 is None or step >= window or updates >= _REFRESH:
+                A = Xp[start:stop]
+                S1 = w @ A
+                S2 = (A * w[:, np.newaxis]).T @ A
+                updates = 0
+            else:
+                for t in range(stop - step, stop):
+                    x_in = Xp[t]
+                    x_out = Xp[t - window]
+                    S1 *= lam
+                    S1 += x_in - lam_w * x_out
+                    S2 *= lam
+                    S2 += np.outer(x_in, x_in) - lam_w * np.outer(x_out, x_out)
+                updates += step
+            yield w_total, S1, S2
+
+    else:
+        # arbitrary window shape - no incremental update possible, one BLAS call per window
+        w = np.asarray(taper, dtype=np.float64)
+        w_total = w.sum()
+        sw = np.sqrt(w)[:, np.newaxis]
+        for start in starts:
+            A = Xp[start:start + window]
+            Aw = A * sw
+            yield w_total, w @ A, Aw.T @ Aw
+
+
+def _correlation_triu(w_total, S1, S2, iu):
+    m = S1 / w_total
+    cov = S2 / w_total - np.outer(m, m)
+    d = np.sqrt(np.maximum(np.diag(cov), 0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return cov[iu] / (d[iu[0]] * d[iu[1]])
+
+
+def n_windows(T, window, step=1):
+    """
+    Number of window positions for a time series of length `T`.
+    """
+    return max(0, (T - window) // step + 1)
+
+
+@instrumented
+def sliding_window_connectivity(Xp, window, step=1, taper=None, tau=None, out=None, dtype=np.float32, generator=False):
+    """
+    Computes correlation matrices of the parcellated time series `Xp` (TxK) in windows of `window` frames
+    moved by `step` frames.
+
+    `taper` can be `None` or `'boxcar'` (rectangular window), `'exponential'` (weights exp(-(age)/tau), with `tau` in frames,
+    by default window/3) or an array of `window` nonnegative weights. For the first two the running sums
+    are updated incrementally.
+
+    Only the upper triangles (without the diagonal, in `np.triu_indices(K, 1)` order) are kept, so that the result
+    has shape `(n_windows, K*(K-1)/2)` and dtype `dtype`. Use `unpack_connectivity` to recover the full matrices.
+    The result is written into `out`, which can be a preallocated array or a filename of a `.npy` file
+    (created as a memory map). With `generator=True` the windows are yielded one by one instead.
+    """
+    Xp = np.asarray(Xp, dtype=np.float64)
+    T, K = Xp.shape
+    assert window <= T, 'window longer than the time series'
+    # checked before anything (e.g. the output file) is created
+    if isinstance(taper, str):
+        if taper not in ('boxcar', 'exponential'):
+            raise ValueError("taper should be None, 'boxcar', 'exponential' or an array of weights")
+    elif taper is not None:
+        w = np.asarray(taper, dtype=np.float64)
+        assert w.shape == (window,) and np.all(w >= 0), 'taper should be a nonnegative array of length window'
+    if isinstance(taper, str) and taper == 'exponential' and tau is None:
+        tau = window / 3.0
+    iu = np.triu_indices(K, 1)
+    moments = _window_moments(Xp, window, step, taper, tau)
+
+    if generator:
+        return (_correlation_triu(w_total, S1, S2, iu).astype(dtype) for w_total, S1, S2 in moments)
+
+    shape = (n_windows(T, window, step), len(iu[0]))
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    elif isinstance(out, np.ndarray):
+        assert out.shape == shape, 'out should have shape {}'.format(shape)
+    else:
+        out = np.lib.format.open_memmap(str(out), mode='w+', dtype=dtype, shape=shape)
+
+    for i, (w_total, S1, S2) in enumerate(moments):
+        out[i] = _correlation_triu(w_total, S1, S2, iu)
+    return out
+
+
+def unpack_connectivity(C, diagonal=1.0):
+    """
+    Converts upper triangles returned by `sliding_window_connectivity` (a single one or a stack)
+    back into full symmetric KxK matrices.
+    """
+    C = np.asarray(C)
+    m = C.shape[-1]
+    K = int(round((1 + np.sqrt(1 + 8 * m)) / 2))
+    assert K * (K - 1) // 2 == m, 'last dimension is not a valid upper triangle'
+    iu = np.triu_indices(K, 1)
+    M = np.empty(C.shape[:-1] + (K, K), dtype=C.dtype)
+    M[..., iu[0], iu[1]] = C
+    M[..., iu[1], iu[0]] = C
+    M[..., np.arange(K), np.arange(K)] = diagonal
+    return M
@@ -0,0 +1,254 @@
+import nibabel as nib
+from sklearn.utils import Bunch
+import numpy as np
+from pathlib import Path
+
+from .hcp_utils import parcellate
+from .profiling import instrumented
+
+# Mass-univariate GLM over grayordinates (or parcels).
+#
+# The design matrix is the same for every grayordinate (and typically for every run),
+# so it is factorized only once. All grayordinates are then fitted together by a single
+# matrix product per chunk. When the data are streamed in time-chunks (e.g. from a
+# .dtseries.nii file) only the sufficient statistics X^T Y and sum(Y^2) are accumulated.
+
+
+def glm_design(design, contrasts=None):
+    """
+    Factorizes the `Txp` design matrix once (through the pseudo-inverse) so that it can be reused
+    for many runs with `glm(Y, design)`.
+    `contrasts` is a dictionary (or a list) of contrasts. A 1D contrast vector of length p defines a t-contrast,
+    a 2D `qxp` array defines an F-contrast.
+    """
+    if isinstance(design, Bunch):
+        if contrasts is not None:
+            # reuse the factorization, only the contrasts are new
+            design = Bunch(**design)
+            design.contrasts = _prepare_contrasts(contrasts, design.XtX_inv)
+        return design
+
+    X = np.asarray(design, dtype=np.float64)
+    assert X.ndim == 2 and X.shape[0] > X.shape[1], 'design should be a Txp matrix with T>p'
+
+    pinv = np.linalg.pinv(X)
+    rank = np.linalg.matrix_rank(X)
+
+    d = Bunch()
+    d.X = X
+    d.pinv = pinv
+    d.XtX_inv = pinv @ pinv.T
+    d.rank = rank
+    d.dof = X.shape[0] - rank
+    d.contrasts = _prepare_contrasts(contrasts, d.XtX_inv)
+    return d
+
+
+def _prepare_contrasts(contrasts, XtX_inv):
+    if contrasts is None:
+        return dict()
+    if not isinstance(contrasts, dict):
+        contrasts = {i: c for i, c in enumerate(contrasts)}
+
+    p = len(XtX_inv)
+    prepared = dict()
+    for name, c in contrasts.items():
+        c = np.asarray(c, dtype=np.float64)
+        assert c.shape[-1] == p, 'contrast {} should have {} columns'.format(name, p)
+        con = Bunch()
+        con.c = c
+        if c.ndim == 1:
+            con.type = 't'
+            con.var_factor = c @ XtX_inv @ c
+        else:
+            con.type = 'F'
+            con.M = np.linalg.pinv(c @ XtX_inv @ c.T)
+            con.q = np.linalg.matrix_rank(c)
+        prepared[name] = con
+    return prepared
+
+
+def _evaluate_contrasts(beta, sigma2, contrasts):
+    out = dict()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for name, con in contrasts.items():
+            res = Bunch()
+            res.type = con.type
+            res.effect = con.c @ beta
+            if con.type == 't':
+                res.variance = sigma2 * con.var_factor
+                res.stat = res.effect / np.sqrt(res.variance)
+            else:
+                res.stat = np.sum(res.effect * (con.M @ res.effect), axis=0) / (con.q * sigma2)
+            out[name] = res
+    return out
+
+
+def _time_chunks(Y, chunk_size):
+    """
+    Yields consecutive `T_chunk x N` blocks of Y together with their starting time index.
+    Y may be an array, a CIFTI image, a filename of a CIFTI file or an iterable of blocks.
+    """
+    if isinstance(Y, (str, Path)):
+        Y = nib.load(str(Y))
+    if isinstance(Y, nib.cifti2.cifti2.Cifti2Image):
+        Y = Y.dataobj
+    if hasattr(Y, 'shape') and hasattr(Y, '__getitem__'):
+        T = Y.shape[0]
+        step = T if chunk_size is None else chunk_size
+        for t0 in range(0, T, step):
+            yield t0, np.asarray(Y[t0:t0 + step])
+    else:
+        t0 = 0
+        for block in Y:
+            block = np.asarray(block)
+            yield t0, block
+            t0 += len(block)
+
+
+def _fit_ols_streamed(Y, design, chunk_size, parcellation):
+    # accumulate X^T Y and sum(Y^2) over time-chunks
+    XtY = None
+    YtY = None
+    T = 0
+    for t0, Yc in _time_chunks(Y, chunk_size):
+        if parcellation is not None:
+            Yc = parcellate(Yc, parcellation)
+        Yc = Yc.astype(np.float64, copy=False)
+        Xc = design.X[t0:t0 + len(Yc)]
+        if XtY is None:
+            XtY = Xc.T @ Yc
+            YtY = np.einsum('ij,ij->j', Yc, Yc)
+        else:
+            XtY += Xc.T @ Yc
+            YtY += np.einsum('ij,ij->j', Yc, Yc)
+        T += len(Yc)
+    assert T == len(design.X), 'data has {} time frames while the design has {}'.format(T, len(design.X))
+
+    beta = design.XtX_inv @ XtY
+    rss = np.maximum(YtY - np.einsum('ij,ij->j', beta, XtY), 0)
+    return beta, rss / design.dof
+
+
+def _fit_ols_columns(Y, design, chunk_size):
+    # Y is in memory: one matrix product per chunk of grayordinates
+    N = Y.shape[1]
+    p = design.X.shape[1]
+    beta = np.empty((p, N))
+    sigma2 = np.empty(N)
+    step = N if chunk_size is None else chunk_size
+    for j0 in range(0, N, step):
+        Yc = Y[:, j0:j0 + step].astype(np.float64, copy=False)
+        b = design.pinv @ Yc
+        resid = Yc - design.X @ b
+        beta[:, j0:j0 + step] = b
+        sigma2[j0:j0 + step] = np.einsum('ij,ij->j', resid, resid) / design.dof
+    return beta, sigma2
+
+
+def _ar1_whiten(A, rho):
+    """
+    Prais-Winsten AR(1) whitening of the columns of A (a scalar or one rho per column).
+    """
+    W = np.empty_like(A)
+    W[0] = np.sqrt(1 - rho**2) * A[0]
+    W[1:] = A[1:] - rho * A[:-1]
+    return W
+
+
+def _fit_ar1(Y, design, chunk_size, ar_bins):
+    N = Y.shape[1]
+    p = design.X.shape[1]
+    step = N if chunk_size is None else chunk_size
+
+    # first pass: OLS residuals -> lag-1 autocorrelation of each grayordinate
+    rho = np.empty(N)
+    for j0 in range(0, N, step):
+        Yc = Y[:, j0:j0 + step].astype(np.float64, copy=False)
+        resid = Yc - design.X @ (design.pinv @ Yc)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r = np.einsum('ij,ij->j', resid[1:], resid[:-1]) / np.einsum('ij,ij->j', resid, resid)
+        rho[j0:j0 + step] = np.nan_to_num(r)
+
+    # grayordinates with similar coefficients share one whitened design factorization
+    rho = np.clip(np.round(rho * ar_bins) / ar_bins, -0.99, 0.99)
+    bins, inverse = np.unique(rho, return_inverse=True)
+
+    beta = np.empty((p, N))
+    sigma2 = np.empty(N)
+    var_factors = {name: np.empty(N) for name, con in design.contrasts.items() if con.type == 't'}
+    Ms = {name: np.empty((N,) + con.M.shape) for name, con in design.contrasts.items() if con.type == 'F'}
+    for b, r in enumerate(bins):
+        cols = np.where(inverse == b)[0]
+        dw = glm_design(_ar1_whiten(design.X, r), {name: con.c for name, con in design.contrasts.items()})
+        for j0 in range(0, len(cols), step):
+            c = cols[j0:j0 + step]
+            bb, s2 = _fit_ols_columns(_ar1_whiten(Y[:, c].astype(np.float64), r), dw, None)
+            beta[:, c] = bb
+            sigma2[c] = s2
+        for name in var_factors:
+            var_factors[name][cols] = dw.contrasts[name].var_factor
+        for name in Ms:
+            Ms[name][cols] = dw.contrasts[name].M
+
+    out = dict()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for name, con in design.contrasts.items():
+            res = Bunch()
+            res.type = con.type
+            res.effect = con.c @ beta
+            if con.type == 't':
+                res.variance = sigma2 * var_factors[name]
+                res.stat = res.effect / np.sqrt(res.variance)
+            else:
+                res.stat = np.einsum('ij,jik,kj->j', res.effect, Ms[name], res.effect) / (con.q * sigma2)
+            out[name] = res
+    return beta, sigma2, rho, out
+
+
+@instrumented
+def glm(Y, design, contrasts=None, parcellation=None, noise_model='ols', chunk_size=None, ar_bins=100):
+    """
+    Fits the same GLM to all grayordinates (columns) of the `TxN` data `Y`.
+
+    `design` is either a `Txp` design matrix or the result of `glm_design(X, contrasts)`, which allows
+    to reuse the factorization of the design for many runs.
+    `Y` can be a numpy array, a CIFTI image, a filename of a `.dtseries.nii` file or an iterable of
+    consecutive time-chunks. With `noise_model='ols'` files and iterables are streamed in time-chunks of
+    `chunk_size` frames, while in-memory arrays are processed in chunks of `chunk_size` grayordinates.
+    If `parcellation` is given, the fit is done at parcel level on `parcellate(Y, parcellation)`.
+
+    `noise_model='ar1'` prewhitens the data with an AR(1) model estimated from the OLS residuals. The AR
+    coefficients are rounded to `1/ar_bins` so that grayordinates with similar coefficients share
+    the factorization of the whitened design.
+
+    Returns a Bunch with `beta` (pxN), `sigma2` (N), `dof` and `contrasts` - a dictionary with the `effect`,
+    `stat` (t or F value) and, for t-contrasts, `variance` of each contrast.
+    """
+    design = glm_design(design, contrasts)
+
+    res = Bunch()
+    res.dof = design.dof
+    if noise_model == 'ols':
+        if isinstance(Y, np.ndarray):
+            if parcellation is not None:
+                Y = parcellate(Y, parcellation)
+            beta, sigma2 = _fit_ols_columns(Y, design, chunk_size)
+        else:
+            beta, sigma2 = _fit_ols_streamed(Y, design, chunk_size, parcellation)
+        res.contrasts = _evaluate_contrasts(beta, sigma2, design.contrasts)
+    elif noise_model == 'ar1':
+        if not isinstance(Y, np.ndarray):
+            # whitening needs whole time series of each grayordinate
+            Y = np.vstack([Yc for _, Yc in _time_chunks(Y, chunk_size)])
+        if parcellation is not None:
+            Y = parcellate(Y, parcellation)
+        beta, sigma2, rho, res.contrasts = _fit_ar1(Y, design, chunk_size, ar_bins)
+        res.rho = rho
+        # the first sample is kept by the Prais-Winsten transform, so the dof are unchanged
+    else:
+        raise ValueError("noise_model should be one of 'ols', 'ar1'")
+
+    res.beta = beta
+    res.sigma2 = sigma2
+    return res
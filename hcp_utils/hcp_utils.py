@@ -7,11 +7,17 @@ import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
 import numpy as np
 import pandas as pd
-from scipy.sparse import load_npz
+from scipy.sparse import load_npz, save_npz, coo_matrix, csr_matrix, block_diag
 from scipy.sparse.csgraph import connected_components
+import hashlib
 import os
 import re
+import tempfile
 from pathlib import Path
+from collections import OrderedDict
+
+from .profiling import instrumented, cache_event
+from .parallel import is_serial, run_chunks
 
 # define standard structures (for 3T HCP-like data)
 
@@ -79,6 +85,89 @@ def get_HCP_vertex_info(img):
     num_meshr = bms[1].surface_number_of_vertices
     return _make_vertex_info(grayl, grayr, num_meshl, num_meshr)
 
+# The subcortical grayordinates are voxels of a volume. Their voxel indices are kept in voxel_info
+# (for a standard 3T HCP style fMRI image get_HCP_voxel_info(img) should coincide with voxel_info)
+
+def _make_voxel_info(ijk, offset, dims, affine):
+    voxel_info = Bunch()
+    voxel_info.ijk = ijk
+    voxel_info.offset = offset
+    voxel_info.dims = dims
+    voxel_info.affine = affine
+    return voxel_info
+
+voxel_data = np.load(PKGDATA / 'fMRI_voxel_info_2mm.npz')
+voxel_info = _make_voxel_info(voxel_data['ijk'], int(voxel_data['offset']), voxel_data['dims'], voxel_data['affine'])
+
+def get_HCP_voxel_info(img):
+    """
+    Extracts the voxel indices of the subcortical grayordinates (and the offset of the first one) from a CIFTI image.
+    Use only for data different from the standard 3T one which is loaded by default.
+    """
+    assert isinstance(img, nib.cifti2.cifti2.Cifti2Image)
+
+    map1 = img.header.get_index_map(1)
+    bms = [bm for bm in map1.brain_models if bm.model_type == 'CIFTI_MODEL_TYPE_VOXELS']
+
+    ijk = np.vstack([np.array(bm.voxel_indices_ijk) for bm in bms])
+    offset = bms[0].index_offset
+    dims = np.array(map1.volume.volume_dimensions)
+    affine = map1.volume.transformation_matrix_voxel_indices_ijk_to_xyz.matrix
+    return _make_voxel_info(ijk, offset, dims, affine)
+
+# The structure slices of other CIFTI layouts (e.g. 7T 170k grayordinates) are read from the brain models
+# of the header. The names follow `struct`, e.g. CIFTI_STRUCTURE_THALAMUS_LEFT -> thalamus_left
+
+_STRUCTURE_NAMES = {'BRAIN_STEM': 'brainStem',
+                    'DIENCEPHALON_VENTRAL_LEFT': 'diencephalon_left',
+                    'DIENCEPHALON_VENTRAL_RIGHT': 'diencephalon_right'}
+
+_struct_cache = dict()
+
+def _structure_name(brain_structure):
+    name = str(brain_structure).replace('CIFTI_STRUCTURE_', '')
+    return _STRUCTURE_NAMES.get(name, name.lower())
+
+def get_HCP_struct(img):
+    """
+    Returns the slices of the structures (in the format of `struct`) of a CIFTI image with any layout of grayordinates.
+    `cortex` and `subcortical` combine the surface and the volume structures respectively.
+    The result is cached by the brain models of the header.
+    For a standard 3T HCP style fMRI image it should coincide with `struct`.
+    """
+    assert isinstance(img, nib.cifti2.cifti2.Cifti2Image)
+
+    map1 = img.header.get_index_map(1)
+    models = [(str(bm.brain_structure), bm.model_type, int(bm.index_offset), int(bm.index_count)) for bm in map1.brain_models]
+    fingerprint = hashlib.sha1(repr(models).encode()).hexdigest()
+    if fingerprint in _struct_cache:
+        cache_event('get_HCP_struct', hit=True)
+        return _struct_cache[fingerprint]
+    cache_event('get_HCP_struct', hit=False)
+
+    end = max(offset + count for _, _, offset, count in models)
+    def make_slice(start, stop):
+        # open ended like `struct` for the last structure
+        return slice(start, None if stop == end else stop)
+
+    surface = [(offset, offset + count) for _, model_type, offset, count in models if model_type == 'CIFTI_MODEL_TYPE_SURFACE']
+    volume = [(offset, offset + count) for _, model_type, offset, count in models if model_type == 'CIFTI_MODEL_TYPE_VOXELS']
+
+    s = Bunch()
+    for brain_structure, model_type, offset, count in models:
+        if model_type == 'CIFTI_MODEL_TYPE_SURFACE':
+            s[_structure_name(brain_structure)] = make_slice(offset, offset + count)
+    if surface:
+        s.cortex = make_slice(min(surface)[0], max(surface)[1])
+    if volume:
+        s.subcortical = make_slice(min(volume)[0], max(volume)[1])
+    for brain_structure, model_type, offset, count in models:
+        if model_type == 'CIFTI_MODEL_TYPE_VOXELS':
+            s[_structure_name(brain_structure)] = make_slice(offset, offset + count)
+
+    _struct_cache[fingerprint] = s
+    return s
+
 
 # The following three functions take a 1D array of fMRI grayordinates
 # and return the array on the left- right- or both surface meshes
@@ -87,34 +176,51 @@ def left_cortex_data(arr, fill=0, vertex_info=vertex_info):
     """
     Takes a 1D array of fMRI grayordinates and returns the values on the vertices of the left cortex mesh which is neccessary for surface visualization. 
     The unused vertices are filled with a constant (zero by default). 
+    A 2D array is treated as a time series of such arrays.
     """
-    out = np.zeros(vertex_info.num_meshl)
+    arr = np.asarray(arr)
+    out = np.zeros(arr.shape[:-1] + (vertex_info.num_meshl,))
     out[:] = fill
-    out[vertex_info.grayl] = arr[:len(vertex_info.grayl)]
+    out[..., vertex_info.grayl] = arr[..., :len(vertex_info.grayl)]
     return out
 
 def right_cortex_data(arr, fill=0, vertex_info=vertex_info):
     """
     Takes a 1D array of fMRI grayordinates and returns the values on the vertices of the right cortex mesh which is neccessary for surface visualization. 
     The unused vertices are filled with a constant (zero by default). 
+    A 2D array is treated as a time series of such arrays.
     """
-    out = np.zeros(vertex_info.num_meshr)
+    arr = np.asarray(arr)
+    out = np.zeros(arr.shape[:-1] + (vertex_info.num_meshr,))
     out[:] = fill
-    if len(arr) == len(vertex_info.grayr):
+    if arr.shape[-1] == len(vertex_info.grayr):
         # means arr is already just the right cortex
-        out[vertex_info.grayr] = arr
+        out[..., vertex_info.grayr] = arr
     else:
-        out[vertex_info.grayr] = arr[len(vertex_info.grayl):len(vertex_info.grayl) + len(vertex_info.grayr)]
+        out[..., vertex_info.grayr] = arr[..., len(vertex_info.grayl):len(vertex_info.grayl) + len(vertex_info.grayr)]
     return out
 
-def cortex_data(arr, fill=0, vertex_info=vertex_info):
+def _cortex_data_into(arr, fill, vertex_info, out):
+    n = vertex_info.num_meshl
+    out[..., :n] = left_cortex_data(arr, fill=fill, vertex_info=vertex_info)
+    out[..., n:] = right_cortex_data(arr, fill=fill, vertex_info=vertex_info)
+
+@instrumented
+def cortex_data(arr, fill=0, vertex_info=vertex_info, n_jobs=None, chunk_size=None):
     """
     Takes a 1D array of fMRI grayordinates and returns the values on the vertices of the full cortex mesh which is neccessary for surface visualization. 
     The unused vertices are filled with a constant (zero by default). 
+    A 2D array is treated as a time series of such arrays, which can be processed in chunks of `chunk_size` time frames
+    by `n_jobs` threads (see `hcp_utils.parallel`).
     """
+    arr = np.asarray(arr)
+    if arr.ndim==2 and not is_serial(n_jobs, chunk_size):
+        out = np.empty((len(arr), vertex_info.num_meshl + vertex_info.num_meshr))
+        run_chunks(lambda c: _cortex_data_into(arr[c], fill, vertex_info, out[c]), len(arr), out[0].nbytes, n_jobs, chunk_size)
+        return out
     dataL = left_cortex_data(arr, fill=fill, vertex_info=vertex_info)
     dataR = right_cortex_data(arr, fill=fill, vertex_info=vertex_info)
-    return np.hstack((dataL, dataR))
+    return np.concatenate((dataL, dataR), axis=-1)
 
 # utility function for making a mesh for both hemispheres
 # used internally by load_surfaces
@@ -129,11 +235,136 @@ def combine_meshes(meshL, meshR):
     faces = np.vstack((facesL, facesR+len(coordL)))
     return coord, faces
 
-# loads all available surface meshes
+# loads surface meshes
+#
+# All variants of the 32k fs_LR meshes share the same triangles, so the face arrays are stored
+# only once per hemisphere (and once for the combined mesh) and shared read-only between the variants.
+# The meshes are loaded lazily, on first access.
+
+MESH_VARIANTS = ['white', 'midthickness', 'pial', 'inflated', 'very_inflated', 'flat', 'sphere']
+
+class SurfaceMeshes(Bunch):
+    """
+    Bunch of surface meshes which loads each mesh on first access.
+    The keys are `variant_left`, `variant_right` and `variant` (both hemispheres) for each available variant,
+    and `sulc`, `sulc_left`, `sulc_right` for the sulcal depth.
+    """
 
-def load_surfaces(example_filename=None, filename_sulc=None):
+    def __init__(self, filenames, filename_sulc=None):
+        super().__init__()
+        # Bunch stores attributes as items, hence object.__setattr__
+        object.__setattr__(self, '_filenames', filenames)
+        object.__setattr__(self, '_filename_sulc', filename_sulc)
+        object.__setattr__(self, '_faces', {'left': [], 'right': []})
+        object.__setattr__(self, '_combined_faces', dict())
+        available = []
+        for variant in MESH_VARIANTS:
+            hemispheres = [h for h in ['left', 'right'] if (variant, h) in filenames]
+            available += [variant + '_' + h for h in hemispheres]
+            if len(hemispheres) == 2:
+                available.append(variant)
+        if filename_sulc is not None:
+            available += ['sulc', 'sulc_left', 'sulc_right']
+        object.__setattr__(self, '_available', available)
+
+    def _shared_faces(self, faces, hemisphere):
+        for f in self._faces[hemisphere]:
+            if f.shape == faces.shape and np.array_equal(f, faces):
+                return f
+        faces = np.array(faces)
+        faces.flags.writeable = False
+        self._faces[hemisphere].append(faces)
+        return faces
+
+    def _load_hemisphere(self, variant, hemisphere):
+        coord, faces = surface.load_surf_mesh(self._filenames[(variant, hemisphere)])
+        if variant=='flat':
+            coordnew = np.zeros_like(coord)
+            coordnew[:, 1] = coord[:, 0]
+            coordnew[:, 2] = coord[:, 1]
+            coordnew[:, 0] = 0
+            coord = coordnew
+        return coord, self._shared_faces(faces, hemisphere)
+
+    def _combine(self, variant):
+        coordl, facesl = self[variant+'_left']
+        coordr, facesr = self[variant+'_right']
+        if variant == 'flat':
+            coordl = coordl.copy()
+            coordl[:, 1] = coordl[:, 1] - 250.0
+            coordr = coordr.copy()
+            coordr[:, 1] = coordr[:, 1] + 250.0
+        key = (id(facesl), id(facesr), len(coordl))
+        faces = self._combined_faces.get(key)
+        if faces is None:
+            faces = np.vstack((facesl, facesr+len(coordl)))
+            faces.flags.writeable = False
+            self._combined_faces[key] = faces
+        return np.vstack((coordl, coordr)), faces
+
+    def _load_sulc(self):
+        sulc_data = - nib.load(self._filename_sulc).get_fdata()[0]
+        if len(sulc_data)==59412:
+            # this happens for HCP S1200 group average data
+            sulc_data = cortex_data(sulc_data)
+        num = len(sulc_data)
+        dict.__setitem__(self, 'sulc', sulc_data)
+        dict.__setitem__(self, 'sulc_left', sulc_data[:num//2])
+        dict.__setitem__(self, 'sulc_right', sulc_data[num//2:])
+
+    def __missing__(self, key):
+        if key not in self._available:
+            raise KeyError(key)
+        if key.startswith('sulc'):
+            self._load_sulc()
+            return dict.__getitem__(self, key)
+        if key.endswith('_left') or key.endswith('_right'):
+            variant, hemisphere = key.rsplit('_', 1)
+            value = self._load_hemisphere(variant, hemisphere)
+        else:
+            value = self._combine(key)
+        self[key] = value
+        return value
+
+    def keys(self):
+        # a keys view like for a plain Bunch, without loading the meshes
+        return dict.fromkeys(list(self._available) + [k for k in dict.keys(self) if k not in self._available]).keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, key):
+        return key in self._available or dict.__contains__(self, key)
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __reduce__(self):
+        # meshes are reloaded lazily after unpickling
+        return (SurfaceMeshes, (self._filenames, self._filename_sulc))
+
+    def load(self):
+        """
+        Loads all available meshes.
+        """
+        for k in self.keys():
+            self[k]
+        return self
+
+
+@instrumented
+def load_surfaces(example_filename=None, filename_sulc=None, variants=None, lazy=True):
     """
-    Loads all available surface meshes and sulcal depth file.
+    Loads available surface meshes and sulcal depth file.
     Combines the left and right hemispheres into joint meshes for the whole brain.
     With no arguments loads the HCP S1200 group average meshes.
     If loading subject specific meshes it is enough to specify a single `example_filename` being one of
@@ -143,6 +374,9 @@ def load_surfaces(example_filename=None, filename_sulc=None):
     mesh = load_surfaces(example_filename='PATH/sub-44.L.pial.32k_fs_LR.surf.gii')
     ```
     The function will load all available surfaces from that location.
+    `variants` restricts the meshes to a list of variants e.g. `variants=['inflated']`.
+    By default (`lazy=True`) each mesh is read from disk only when it is first accessed,
+    the face arrays are shared (read-only) between all variants.
 
     """
     if example_filename is None:
@@ -153,58 +387,85 @@ def load_surfaces(example_filename=None, filename_sulc=None):
 
     flatsphere_pattern = str(PKGDATA / 'S1200.{}.{}.32k_fs_LR.surf.gii')
 
-    meshes = Bunch()
-    for variant in ['white', 'midthickness', 'pial', 'inflated', 'very_inflated', 'flat' , 'sphere']:
-        count = 0
+    if variants is None:
+        variants = MESH_VARIANTS
+    for variant in variants:
+        if variant not in MESH_VARIANTS:
+            raise ValueError('variants should be among ' + ','.join(MESH_VARIANTS))
+
+    filenames = dict()
+    for variant in variants:
         for hemisphere, hemisphere_name in [('L', 'left'), ('R', 'right')]:
             if variant in ['flat' , 'sphere']:
                 filename = flatsphere_pattern.format(hemisphere, variant)
             else:
                 filename = filename_pattern.format(hemisphere, variant)
             if os.path.exists(filename):
-                coord, faces = surface.load_surf_mesh(filename)
-                if variant=='flat':
-                    coordnew = np.zeros_like(coord)
-                    coordnew[:, 1] = coord[:, 0]
-                    coordnew[:, 2] = coord[:, 1]
-                    coordnew[:, 0] = 0
-                    coord = coordnew
-                meshes[variant+'_'+hemisphere_name] = coord, faces
-                count += 1
+                filenames[(variant, hemisphere_name)] = filename
             else:
                 print('Cannot find', filename)
-        if count==2:
-            if variant == 'flat':
-                coordl, facesl = meshes['flat_left']
-                coordr, facesr = meshes['flat_right']
-                coordlnew = coordl.copy()
-                coordlnew[:, 1] = coordl[:, 1] - 250.0
-                coordrnew = coordr.copy()
-                coordrnew[:, 1] = coordr[:, 1] + 250.0
-                meshes['flat'] = combine_meshes( (coordlnew, facesl), (coordrnew, facesr) )
-            else:
-                meshes[variant] = combine_meshes(meshes[variant+'_left'], meshes[variant+'_right'])
 
     if filename_sulc is None:
         filename_sulc = filename_pattern.format('XX','XX').replace('XX.XX', 'sulc').replace('surf.gii','dscalar.nii')
-    if os.path.exists(filename_sulc):
-        sulc_data = - nib.load(filename_sulc).get_fdata()[0]
-        if len(sulc_data)==59412:
-            # this happens for HCP S1200 group average data
-            sulc_data = cortex_data(sulc_data)
-        meshes['sulc'] = sulc_data
-        num = len(meshes.sulc)
-        meshes['sulc_left'] = meshes.sulc[:num//2]
-        meshes['sulc_right'] = meshes.sulc[num//2:]
-    else:
+    if not os.path.exists(filename_sulc):
         print('Cannot load file {} with sulcal depth data'.format(filename_sulc))
+        filename_sulc = None
 
+    meshes = SurfaceMeshes(filenames, filename_sulc)
+    if not lazy:
+        meshes.load()
     return meshes
 
+# vertex areas (one third of the area of the adjacent triangles), cached for the few most recently used meshes
+# (numpy arrays cannot be keys of a WeakKeyDictionary, so per-subject meshes are evicted instead)
+
+_vertex_area_cache = OrderedDict()
+VERTEX_AREA_CACHE_SIZE = 8
+
+@instrumented
+def vertex_areas(meshLR):
+    """
+    Computes the area associated to each vertex of the mesh (one third of the total area of the adjacent triangles).
+    The results of the `VERTEX_AREA_CACHE_SIZE` most recently used meshes are cached.
+    """
+    coord, faces = meshLR
+    cached = _vertex_area_cache.get(id(coord))
+    if cached is not None and cached[0] is coord:
+        cache_event('vertex_areas', hit=True)
+        _vertex_area_cache.move_to_end(id(coord))
+        return cached[1]
+    cache_event('vertex_areas', hit=False)
+
+    v0 = coord[faces[:, 0]]
+    face_areas = 0.5 * np.linalg.norm(np.cross(coord[faces[:, 1]] - v0, coord[faces[:, 2]] - v0), axis=1)
+    areas = np.bincount(faces.ravel(), weights=np.repeat(face_areas / 3.0, 3), minlength=len(coord))
+    _vertex_area_cache[id(coord)] = (coord, areas)
+    _vertex_area_cache.move_to_end(id(coord))
+    while len(_vertex_area_cache) > VERTEX_AREA_CACHE_SIZE:
+        _vertex_area_cache.popitem(last=False)
+    return areas
+
+def grayordinate_areas(meshLR=None, vertex_info=vertex_info, n_grayordinates=91282, subcortical_fill=None):
+    """
+    Returns the vertex area of each cortical grayordinate on the whole brain mesh `meshLR` (`mesh.midthickness` by default).
+    The subcortical grayordinates (up to `n_grayordinates` in total) are set to `subcortical_fill`,
+    by default the mean cortical vertex area, so that they can enter area-weighted averages.
+    """
+    if meshLR is None:
+        meshLR = mesh.midthickness
+    areas = vertex_areas(meshLR)
+    cortex_areas = np.hstack((areas[vertex_info.grayl], areas[vertex_info.num_meshl + vertex_info.grayr]))
+    if subcortical_fill is None:
+        subcortical_fill = np.mean(cortex_areas)
+    out = np.full(n_grayordinates, subcortical_fill, dtype=np.float64)
+    out[:len(cortex_areas)] = cortex_areas
+    return out
+
 mesh = load_surfaces()
 
 # parcellations
 
+@instrumented
 def _load_hcp_parcellation(variant=None):
     allowed = ['mmp', 'ca_network', 'ca_parcels', 'yeo7', 'yeo17', 'standard']
     if variant not in allowed:
@@ -264,13 +525,9 @@ def view_parcellation(meshLR, parcellation):
     """
     # for some parcellations the numerical ids need not be consecutive
     cortex_map = cortex_data(parcellation.map_all)
-    ids = np.unique(cortex_map)
-    normalized_cortex_map = np.zeros_like(cortex_map)
-    rgba = np.zeros((len(ids), 4))
-    for i in range(len(ids)):
-        ind = cortex_map==ids[i]
-        normalized_cortex_map[ind] = i
-        rgba[i,:] = parcellation.rgba[ids[i]]
+    ids, normalized_cortex_map = np.unique(cortex_map, return_inverse=True)
+    normalized_cortex_map = normalized_cortex_map.astype(cortex_map.dtype)
+    rgba = np.array([parcellation.rgba[k] for k in ids.astype(int)])
 
     cmap = matplotlib.colors.ListedColormap(rgba)
     return plotting.view_surf(meshLR, normalized_cortex_map, symmetric_cmap=False, cmap=cmap)
@@ -322,53 +579,105 @@ def parcellation_labels(parcellation):
     plt.subplots_adjust(left=0, right=1, top=1, bottom=0, hspace=0, wspace=0)
     
 
-def parcellate(X, parcellation, method=np.mean):
+@instrumented
+def parcellate(X, parcellation, method=np.mean, weights=None, n_jobs=None, chunk_size=None):
     """
     Parcellates the data into ROI's using `method` (mean by default). Ignores the unassigned grayordinates with id=0.
     Works both for time-series 2D data and snapshot 1D data.
+    If `weights` is given, a weighted mean is computed instead (and `method` is ignored). `weights='area'` weights
+    the cortical grayordinates by their vertex areas on `mesh.midthickness` (see `grayordinate_areas`),
+    alternatively an array of weights of each grayordinate can be passed.
+    Time series can be processed in chunks of `chunk_size` time frames by `n_jobs` threads (see `hcp_utils.parallel`).
     """
+    P = None
+    if weights is not None:
+        P = _parcellation_weights(parcellation, weights)
+        dtype = np.result_type(X.dtype, np.float32)
+    else:
+        dtype = X.dtype
+
     n = np.sum(parcellation.ids!=0)
     if X.ndim==2:
-        Xp = np.zeros((len(X), n), dtype=X.dtype)
+        Xp = np.zeros((len(X), n), dtype=dtype)
+        if not is_serial(n_jobs, chunk_size):
+            columns = _parcel_columns(parcellation) if P is None else None
+            run_chunks(lambda c: _parcellate_into(X[c], columns, method, P, Xp[c]), len(X), X[0].nbytes, n_jobs, chunk_size)
+            return Xp
     else:
-        Xp = np.zeros(np, dtype=X.dtype)
-    i = 0
-    for k in parcellation.ids:
-        if k!=0:
-            if X.ndim==2:
-                Xp[:, i] = method(X[:, parcellation.map_all==k], axis=1)
-            else:
-                Xp[i] = method(X[parcellation.map_all==k])
-            i += 1
+        Xp = np.zeros(n, dtype=dtype)
+    _parcellate_into(X, (parcellation.map_all==k for k in parcellation.ids if k!=0), method, P, Xp)
     return Xp
 
-def unparcellate(Xp, parcellation):
+def _parcel_columns(parcellation):
+    # grayordinates of each parcel, shared by all the chunks
+    return [np.flatnonzero(parcellation.map_all==k) for k in parcellation.ids if k!=0]
+
+def _parcellate_into(X, columns, method, P, Xp):
+    if P is not None:
+        Xp[:] = (P.T @ X.T).T
+        return
+    for i, cols in enumerate(columns):
+        if X.ndim==2:
+            Xp[:, i] = method(X[:, cols], axis=1)
+        else:
+            Xp[i] = method(X[cols])
+
+def _parcellation_weights(parcellation, weights):
+    # weighted means as a product with a sparse NxK matrix of normalized weights
+    index = _parcel_index(parcellation)
+    if isinstance(weights, str):
+        assert weights == 'area', "weights should be 'area' or an array"
+        weights = grayordinate_areas(n_grayordinates=len(index))
+    weights = np.asarray(weights, dtype=np.float64)
+    n = len(parcellation.nontrivial_ids)
+    assigned = np.where(index >= 0)[0]
+    totals = np.bincount(index[assigned], weights=weights[assigned], minlength=n)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        values = weights[assigned] / totals[index[assigned]]
+    return csr_matrix((values, (assigned, index[assigned])), shape=(len(index), n))
+
+@instrumented
+def unparcellate(Xp, parcellation, n_jobs=None, chunk_size=None):
     """
     Takes as input time-series (2D) or snapshot (1D) parcellated data.
     Creates full grayordinate data with grayordinates set to the value of the parcellated data.
     Can be useful for visualization.
+    Time series can be processed in chunks of `chunk_size` time frames by `n_jobs` threads (see `hcp_utils.parallel`).
     """
     n = len(parcellation.map_all)
     if Xp.ndim==2:
         X = np.zeros((len(Xp), n), dtype=Xp.dtype)
+        if not is_serial(n_jobs, chunk_size):
+            columns = _parcel_columns(parcellation)
+            run_chunks(lambda c: _unparcellate_into(Xp[c], columns, X[c]), len(Xp), X[0].nbytes, n_jobs, chunk_size)
+            return X
     else:
         X = np.zeros(n, dtype=Xp.dtype)
-    i = 0
-    for k in parcellation.ids:
-        if k!=0:
-            if Xp.ndim==2:
-                X[:, parcellation.map_all==k] = Xp[:,i][:,np.newaxis]
-            else:
-                X[parcellation.map_all==k] = Xp[i]
-            i += 1
+    _unparcellate_into(Xp, (parcellation.map_all==k for k in parcellation.ids if k!=0), X)
     return X
 
-def mask(X, mask, fill=0):
+def _unparcellate_into(Xp, columns, X):
+    for i, cols in enumerate(columns):
+        if Xp.ndim==2:
+            X[:, cols] = Xp[:,i][:,np.newaxis]
+        else:
+            X[cols] = Xp[i]
+
+@instrumented
+def mask(X, mask, fill=0, n_jobs=None, chunk_size=None):
     """
     Takes 1D data `X` and a mask `mask`. Sets the exterior of mask to a constant (by default zero).
     Can be useful for visualization.
+    A boolean mask of the same shape as `X` can be applied in chunks (along the first axis) by `n_jobs` threads
+    (see `hcp_utils.parallel`).
     """
     X_masked = np.zeros_like(X)
+    if not is_serial(n_jobs, chunk_size) and getattr(mask, 'dtype', None) == bool and mask.shape == X.shape:
+        def work(c):
+            X_masked[c] = fill
+            np.copyto(X_masked[c], X[c], where=mask[c])
+        run_chunks(work, len(X), X[0].nbytes if X.ndim > 1 else X.itemsize, n_jobs, chunk_size)
+        return X_masked
     X_masked[:] = fill
     X_masked[mask] = X[mask]
     return X_masked
@@ -390,7 +699,46 @@ def ranking(Xp, parcellation, descending=True):
         ids.append(k)
     return pd.DataFrame({'region':labels, 'id':ids, 'data':Xp[ind]})
 
-
+def parcel_geometry(parcellation, meshLR=None, vertex_info=vertex_info):
+    """
+    Returns a dataframe with the geometry of each parcel on the whole brain mesh `meshLR` (`mesh.midthickness` by default):
+    the number of grayordinates, the number of cortical grayordinates, the cortical surface area,
+    the area-weighted centroid `x, y, z` of the cortical part and the hemisphere (`L`, `R`, `LR` or `subcortical`).
+    """
+    if meshLR is None:
+        meshLR = mesh.midthickness
+    coord, _ = meshLR
+    n = len(parcellation.nontrivial_ids)
+    n_left = len(vertex_info.grayl)
+    index = _parcel_index(parcellation)
+
+    vertices = np.hstack((vertex_info.grayl, vertex_info.num_meshl + vertex_info.grayr))
+    cortex_index = index[:len(vertices)]
+    assigned = cortex_index >= 0
+    vertices = vertices[assigned]
+    cortex_index = cortex_index[assigned]
+    areas = vertex_areas(meshLR)[vertices]
+
+    area = np.bincount(cortex_index, weights=areas, minlength=n)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        centroid = np.stack([np.bincount(cortex_index, weights=areas * coord[vertices, d], minlength=n) / area for d in range(3)], axis=1)
+
+    is_left = np.where(assigned)[0] < n_left
+    n_left_parcel = np.bincount(cortex_index[is_left], minlength=n)
+    n_right_parcel = np.bincount(cortex_index[~is_left], minlength=n)
+    hemisphere = np.where(n_left_parcel > 0, np.where(n_right_parcel > 0, 'LR', 'L'), np.where(n_right_parcel > 0, 'R', 'subcortical'))
+
+    return pd.DataFrame({'id': parcellation.nontrivial_ids,
+                         'region': [parcellation.labels[k] for k in parcellation.nontrivial_ids],
+                         'n_grayordinates': np.bincount(index[index >= 0], minlength=n),
+                         'n_cortical': n_left_parcel + n_right_parcel,
+                         'area': area,
+                         'x': centroid[:, 0], 'y': centroid[:, 1], 'z': centroid[:, 2],
+                         'hemisphere': hemisphere})
+
+
+
+@instrumented
 def make_lr_parcellation(parcellation):
     """
     Takes the given parcellation and produces a new one where parcels in the left and right hemisphere are made to be distinct.
@@ -447,19 +795,311 @@ def make_lr_parcellation(parcellation):
 
     return new_parcellation
 
+# hierarchies of parcellations (e.g. mmp -> yeo7 or ca_parcels -> ca_network)
+
+def _parcel_index(parcellation):
+    """
+    Returns for each grayordinate the column index of its parcel in the parcellated data (-1 for unassigned).
+    """
+    nontrivial_ids = np.asarray(parcellation.nontrivial_ids)
+    lookup = -np.ones(max(np.amax(parcellation.map_all), np.amax(nontrivial_ids, initial=0)) + 1, dtype=int)
+    lookup[nontrivial_ids] = np.arange(len(nontrivial_ids))
+    return lookup[parcellation.map_all]
+
+
+def _overlap_counts(index_a, n_a, index_b, n_b):
+    """
+    Sparse `n_a x n_b` table with the number of grayordinates shared by each pair of parcels,
+    computed in a single pass over the parcel indices (-1 means unassigned and is skipped).
+    """
+    valid = (index_a >= 0) & (index_b >= 0)
+    counts = coo_matrix((np.ones(np.count_nonzero(valid), dtype=np.int64), (index_a[valid], index_b[valid])), shape=(n_a, n_b))
+    return counts.tocsr()
+
+
+def parcellation_hierarchy(fine, coarse=None, table=None):
+    """
+    Derives a mapping of the parcels of the `fine` parcellation onto the regions of the `coarse` one.
+    By default each fine parcel is assigned to the coarse region with which it has the largest overlap.
+    Alternatively an explicit `table` - a dictionary `{fine_id: coarse_id}` - can be given.
+    Returns a Bunch with the sparse `K x K'` assignment matrix `mapping`, the `fine_ids`, the `coarse_ids`
+    and the grayordinate counts `sizes` of the fine parcels.
+    Fine parcels which are not assigned to any coarse region are dropped by the aggregation functions.
+    """
+    fine_ids = np.asarray(fine.nontrivial_ids)
+    fine_index = _parcel_index(fine)
+    sizes = np.bincount(fine_index[fine_index >= 0], minlength=len(fine_ids))
+
+    if table is None:
+        assert coarse is not None, 'either coarse or table has to be given'
+        coarse_ids = np.asarray(coarse.nontrivial_ids)
+        counts = _overlap_counts(fine_index, len(fine_ids), _parcel_index(coarse), len(coarse_ids))
+        rows = np.where(counts.getnnz(axis=1) > 0)[0]
+        cols = np.asarray(counts[rows].argmax(axis=1)).ravel()
+    else:
+        if coarse is None:
+            coarse_ids = np.unique([v for v in table.values() if v != 0])
+        else:
+            coarse_ids = np.asarray(coarse.nontrivial_ids)
+        fine_pos = {k: i for i, k in enumerate(fine_ids)}
+        coarse_pos = {k: i for i, k in enumerate(coarse_ids)}
+        pairs = [(fine_pos[k], coarse_pos[v]) for k, v in table.items() if k in fine_pos and v in coarse_pos]
+        rows = np.array([p[0] for p in pairs], dtype=int)
+        cols = np.array([p[1] for p in pairs], dtype=int)
+
+    hierarchy = Bunch()
+    hierarchy.mapping = csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(fine_ids), len(coarse_ids)))
+    hierarchy.fine_ids = fine_ids
+    hierarchy.coarse_ids = coarse_ids
+    hierarchy.sizes = sizes
+    return hierarchy
+
+
+def _hierarchy_weights(hierarchy, weighted):
+    W = hierarchy.mapping.toarray()
+    if weighted:
+        W = W * hierarchy.sizes[:, np.newaxis]
+    return W
+
+
+def aggregate_parcels(Xp, hierarchy, weighted=True):
+    """
+    Aggregates parcellated time-series (2D) or snapshot (1D) data `Xp` to the coarse regions of `hierarchy`
+    (see `parcellation_hierarchy`).
+    With `weighted=True` fine parcels are weighted by their number of grayordinates, so that for parcel means
+    the result coincides with the mean over all grayordinates of the assigned fine parcels.
+    Otherwise the plain mean of the fine parcel values is taken.
+    """
+    W = _hierarchy_weights(hierarchy, weighted)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        W = W / W.sum(axis=0)
+    return Xp @ W
+
+
+def aggregate_connectivity(C, hierarchy, weighted=False, exclude_diagonal=True):
+    """
+    Block-averages a `KxK` connectivity matrix between fine parcels (or a stack of them with shape `(n, K, K)`)
+    into a `K'xK'` matrix between the coarse regions of `hierarchy` (see `parcellation_hierarchy`).
+    With `exclude_diagonal=True` the self-connections of the fine parcels are left out of the diagonal blocks.
+    `weighted=True` weights the entries by the product of the grayordinate counts of the two fine parcels.
+    """
+    W = _hierarchy_weights(hierarchy, weighted)
+    C = np.asarray(C)
+    denominator = np.outer(W.sum(axis=0), W.sum(axis=0))
+    if exclude_diagonal:
+        K = C.shape[-1]
+        C = C.copy()
+        C[..., np.arange(K), np.arange(K)] = 0
+        denominator = denominator - np.diag(np.sum(W**2, axis=0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (W.T @ C @ W) / denominator
+
+# overlap (contingency) analysis of two parcellations
+
+def _overlap_index(parcellation, region=None):
+    """
+    Returns the parcel ids and the parcel index of each grayordinate (-1 for unassigned).
+    `parcellation` can be a parcellation Bunch (the index then follows the columns of `parcellate`),
+    a 1D integer map or a 2D stack of maps (e.g. of individual subjects) sharing the same ids.
+    """
+    if isinstance(parcellation, Bunch):
+        ids = np.asarray(parcellation.nontrivial_ids)
+        index = _parcel_index(parcellation)
+    else:
+        maps = np.asarray(parcellation)
+        ids, index = np.unique(maps, return_inverse=True)
+        index = index.reshape(maps.shape)
+        if ids[0] == 0:
+            ids = ids[1:]
+            index = index - 1
+    if region is not None:
+        index = index[..., region]
+    return ids, index
+
+
+@instrumented
+def parcellation_overlap(parcellation_a, parcellation_b, region=None):
+    """
+    Computes the sparse contingency table `counts` of the two parcellations (number of grayordinates
+    shared by each pair of parcels) in a single pass, restricted to `region` (e.g. `struct.cortex_left`) if given.
+    The parcellations can be given as parcellation Bunches or as integer maps of grayordinate ids.
+    Returns a Bunch with `counts`, the sparse `dice` and `jaccard` tables, the parcel `sizes_a`, `sizes_b` and ids `ids_a`, `ids_b`.
+    """
+    ids_a, index_a = _overlap_index(parcellation_a, region)
+    ids_b, index_b = _overlap_index(parcellation_b, region)
+    assert index_a.ndim == 1 and index_b.ndim == 1, 'use parcellation_similarity for stacks of parcellations'
+
+    counts = _overlap_counts(index_a, len(ids_a), index_b, len(ids_b))
+    sizes_a = np.bincount(index_a[index_a >= 0], minlength=len(ids_a))
+    sizes_b = np.bincount(index_b[index_b >= 0], minlength=len(ids_b))
+
+    coo = counts.tocoo()
+    sum_ab = sizes_a[coo.row] + sizes_b[coo.col]
+
+    overlap = Bunch()
+    overlap.counts = counts
+    overlap.dice = csr_matrix((2.0 * coo.data / sum_ab, (coo.row, coo.col)), shape=counts.shape)
+    overlap.jaccard = csr_matrix((coo.data / (sum_ab - coo.data), (coo.row, coo.col)), shape=counts.shape)
+    overlap.sizes_a = sizes_a
+    overlap.sizes_b = sizes_b
+    overlap.ids_a = ids_a
+    overlap.ids_b = ids_b
+    return overlap
+
+
+def parcel_composition(parcellation_a, parcellation_b, region=None):
+    """
+    Returns a dataframe with the fraction of each parcel of `parcellation_a` falling into each region of `parcellation_b`
+    (e.g. which networks of `yeo7` a given `mmp` parcel falls in). Rows need not sum to one if some grayordinates
+    are unassigned in `parcellation_b`.
+    """
+    overlap = parcellation_overlap(parcellation_a, parcellation_b, region)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fractions = overlap.counts.toarray() / overlap.sizes_a[:, np.newaxis]
+
+    def names(parcellation, ids):
+        if isinstance(parcellation, Bunch):
+            return [parcellation.labels[k] for k in ids]
+        return list(ids)
+
+    return pd.DataFrame(fractions, index=names(parcellation_a, overlap.ids_a), columns=names(parcellation_b, overlap.ids_b))
+
+
+def _comb2(n):
+    return n * (n - 1) / 2.0
+
+
+@instrumented
+def parcellation_similarity(parcellations, reference, region=None):
+    """
+    Computes the adjusted Rand index `ari` and the normalized mutual information `nmi` (arithmetic normalization)
+    between `parcellations` and the `reference` parcellation using only grayordinates assigned in both.
+    `parcellations` can be a single parcellation (Bunch or 1D map) or a 2D `n_subjects x N` stack of individual
+    parcellation maps, in which case all of them are processed together and arrays of length n_subjects are returned.
+    """
+    ids_a, index_a = _overlap_index(parcellations, region)
+    ids_b, index_b = _overlap_index(reference, region)
+    single = index_a.ndim == 1
+    index_a = np.atleast_2d(index_a)
+    S = len(index_a)
+    n_a = len(ids_a)
+    n_b = len(ids_b)
+
+    # one sparse contingency table with a block of n_a rows for each subject
+    subject, g = np.nonzero((index_a >= 0) & (index_b >= 0))
+    ia = index_a[subject, g]
+    ib = index_b[g]
+    ones = np.ones(len(g))
+    counts = coo_matrix((ones, (subject * n_a + ia, ib)), shape=(S * n_a, n_b)).tocsr().tocoo()
+    a = coo_matrix((ones, (subject, ia)), shape=(S, n_a)).toarray()
+    b = coo_matrix((ones, (subject, ib)), shape=(S, n_b)).toarray()
+    n = a.sum(axis=1)
+    nij = counts.data
+    s_ij = counts.row // n_a
+
+    sum_ij = np.bincount(s_ij, weights=_comb2(nij), minlength=S)
+    sum_a = _comb2(a).sum(axis=1)
+    sum_b = _comb2(b).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = sum_a * sum_b / _comb2(n)
+        ari = (sum_ij - expected) / ((sum_a + sum_b) / 2 - expected)
+        ari = np.where((sum_a + sum_b) / 2 == expected, 1.0, ari)
+
+        p_ij = nij / n[s_ij]
+        mi = np.bincount(s_ij, weights=p_ij * np.log(nij * n[s_ij] / (a[s_ij, counts.row % n_a] * b[s_ij, counts.col])), minlength=S)
+        pa = a / n[:, np.newaxis]
+        pb = b / n[:, np.newaxis]
+        h_a = -np.sum(np.where(pa > 0, pa * np.log(pa), 0), axis=1)
+        h_b = -np.sum(np.where(pb > 0, pb * np.log(pb), 0), axis=1)
+        nmi = np.where((h_a + h_b) == 0, 1.0, mi / ((h_a + h_b) / 2))
+
+    similarity = Bunch()
+    similarity.ari = ari[0] if single else ari
+    similarity.nmi = nmi[0] if single else nmi
+    return similarity
+
 # Other utilities
 
-def normalize(X):
+@instrumented
+def normalize(X, n_jobs=None, chunk_size=None):
     """
     Normalizes data so that each grayordinate has zero (temporal) mean and unit standard deviation.
+    The grayordinates can be processed in chunks of `chunk_size` columns by `n_jobs` threads (see `hcp_utils.parallel`).
     """
+    if X.ndim==2 and not is_serial(n_jobs, chunk_size):
+        out = np.empty(X.shape, dtype=np.result_type(X.dtype, np.mean(X[:, :1], axis=0).dtype))
+        def work(c):
+            Xc = X[:, c]
+            out[:, c] = (Xc - np.mean(Xc,axis=0))/np.std(Xc,axis=0)
+        run_chunks(work, X.shape[1], len(X) * X.itemsize, n_jobs, chunk_size)
+        return out
     return (X - np.mean(X,axis=0))/np.std(X,axis=0)
 
+_COMBINED_STRUCTURES = ('cortex', 'subcortical')
+
+def _atomic_structures(struct, n):
+    # the nonempty structures without the combined ones, duplicates and the ones containing others, sorted by position
+    extent = max((s.start or 0) + 1 if s.stop is None else s.stop for s in struct.values())
+    assert extent <= n, 'the structures need at least {} grayordinates but the data have only {}'.format(extent, n)
+    bounds = dict()
+    for name, s in struct.items():
+        start, stop = s.indices(n)[:2]
+        if name not in _COMBINED_STRUCTURES and stop > start and (start, stop) not in bounds.values():
+            bounds[name] = (start, stop)
+    atomic = [name for name, (start, stop) in bounds.items()
+              if not any(name != other and start <= a and b <= stop for other, (a, b) in bounds.items())]
+    return sorted(atomic, key=lambda name: bounds[name]), bounds
+
+@instrumented
+def structure_statistics(X, struct=struct, statistics=('mean', 'std')):
+    """
+    Computes the `statistics` ('mean', 'std', 'sum', 'min', 'max') of the grayordinates of each structure
+    for time-series 2D data or snapshot 1D data in a single `reduceat` pass per statistic.
+    Combined structures (`cortex`, `subcortical`) and empty ones are left out. The data should cover all the structures
+    of `struct`. For other layouts of grayordinates pass `struct=get_HCP_struct(img)`.
+    Returns a Bunch with the structure `names`, their `sizes` and an array (time x structures) for each statistic.
+    """
+    for stat in statistics:
+        if stat not in ('mean', 'std', 'sum', 'min', 'max'):
+            raise ValueError("statistics should be among 'mean', 'std', 'sum', 'min', 'max'")
+    n = X.shape[-1]
+    names, bounds = _atomic_structures(struct, n)
+    starts = np.array([bounds[name][0] for name in names])
+    stops = np.array([bounds[name][1] for name in names])
+    assert np.all(starts[1:] >= stops[:-1]), 'structures should not overlap'
+
+    # segments between all the boundaries, the structures are the ones starting at their starts
+    boundaries = np.unique(np.concatenate([starts, stops]))
+    boundaries = boundaries[boundaries < n]
+    segments = np.searchsorted(boundaries, starts)
+    sizes = stops - starts
+
+    res = Bunch()
+    res.names = names
+    res.sizes = sizes
+    if 'sum' in statistics or 'mean' in statistics or 'std' in statistics:
+        sums = np.add.reduceat(X, boundaries, axis=-1, dtype=np.float64)[..., segments]
+        means = sums / sizes
+    for stat in statistics:
+        if stat == 'sum':
+            res.sum = sums
+        elif stat == 'mean':
+            res.mean = means
+        elif stat == 'std':
+            squares = np.add.reduceat(np.square(X, dtype=np.float64), boundaries, axis=-1)[..., segments]
+            res.std = np.sqrt(np.maximum(squares / sizes - means**2, 0))
+        elif stat == 'min':
+            res.min = np.minimum.reduceat(X, boundaries, axis=-1)[..., segments]
+        elif stat == 'max':
+            res.max = np.maximum.reduceat(X, boundaries, axis=-1)[..., segments]
+    return res
+
 
 # cortical adjacency matrix
 
 cortical_adjacency = load_npz(PKGDATA / 'cortical_adjacency.npz')
 
+@instrumented
 def cortical_components(condition, cutoff=0):
     """
     Decomposes boolean array condition into connected components on the cortex.
@@ -489,5 +1129,313 @@ def cortical_components(condition, cutoff=0):
 
     return n_components, sizes, rois
 
+# subcortical voxel adjacency matrix
+#
+# built from the voxel indices on first use and cached in memory and on disk
+# (in HCP_UTILS_CACHE_DIR, by default ~/.cache/hcp_utils)
+
+CACHE_DIR = Path(os.environ.get('HCP_UTILS_CACHE_DIR', Path.home() / '.cache' / 'hcp_utils'))
+
+_adjacency_cache = dict()
+
+def _voxel_offsets(connectivity):
+    offsets = np.array([(i, j, k) for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1) if (i, j, k) != (0, 0, 0)])
+    n_nonzero = np.abs(offsets).sum(axis=1)
+    if connectivity == 6:
+        return offsets[n_nonzero == 1]
+    if connectivity == 18:
+        return offsets[n_nonzero <= 2]
+    if connectivity == 26:
+        return offsets
+    raise ValueError('connectivity should be one of 6, 18, 26')
+
+def subcortical_adjacency(connectivity=26, voxel_info=voxel_info):
+    """
+    Returns the sparse adjacency matrix of the subcortical grayordinates (voxels sharing a face for `connectivity=6`,
+    also an edge for 18 and also a corner for 26).
+    The matrix is cached in memory and on disk.
+    """
+    ijk = np.asarray(voxel_info.ijk, dtype=np.int64)
+    fingerprint = hashlib.sha1(ijk.tobytes() + np.asarray(voxel_info.dims, dtype=np.int64).tobytes()).hexdigest()[:16]
+    key = (fingerprint, connectivity)
+    if key in _adjacency_cache:
+        cache_event('subcortical_adjacency', hit=True)
+        return _adjacency_cache[key]
+
+    filename = CACHE_DIR / 'subcortical_adjacency_{}_{}.npz'.format(fingerprint, connectivity)
+    adj = _load_cached_adjacency(filename, len(ijk))
+    cache_event('subcortical_adjacency_disk', hit=adj is not None)
+    if adj is None:
+        adj = _build_subcortical_adjacency(ijk, np.asarray(voxel_info.dims), connectivity)
+        _save_cached_adjacency(filename, adj)
+
+    _adjacency_cache[key] = adj
+    return adj
+
+def _load_cached_adjacency(filename, n):
+    # a missing, truncated or otherwise unreadable file is a cache miss
+    try:
+        adj = load_npz(filename)
+    except Exception:
+        return None
+    if adj.shape != (n, n):
+        return None
+    return adj.tocsr()
+
+def _save_cached_adjacency(filename, adj):
+    # written to a temporary file and renamed, so that concurrent workers never see a partial file
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        fd, tmpname = tempfile.mkstemp(dir=CACHE_DIR, prefix=filename.stem, suffix='.tmp.npz')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                save_npz(f, adj)
+            os.replace(tmpname, filename)
+        except BaseException:
+            os.unlink(tmpname)
+            raise
+    except OSError:
+        pass
+
+def _build_subcortical_adjacency(ijk, dims, connectivity):
+    n = len(ijk)
+    volume = -np.ones(dims, dtype=np.int64)
+    volume[ijk[:, 0], ijk[:, 1], ijk[:, 2]] = np.arange(n)
+
+    rows = []
+    cols = []
+    for offset in _voxel_offsets(connectivity):
+        neighbour = ijk + offset
+        inside = np.all((neighbour >= 0) & (neighbour < dims), axis=1)
+        j = -np.ones(n, dtype=np.int64)
+        j[inside] = volume[neighbour[inside, 0], neighbour[inside, 1], neighbour[inside, 2]]
+        rows.append(np.where(j >= 0)[0])
+        cols.append(j[j >= 0])
+    rows = np.hstack(rows)
+    cols = np.hstack(cols)
+    return csr_matrix((np.ones(len(rows), dtype=int), (rows, cols)), shape=(n, n))
+
+def whole_brain_adjacency(connectivity=26, voxel_info=voxel_info):
+    """
+    Returns the sparse 91282x91282 adjacency matrix of all grayordinates: `cortical_adjacency` for the cortex
+    and `subcortical_adjacency(connectivity)` for the subcortical voxels. The cortex and the subcortical structures
+    are not connected with each other.
+    """
+    sub = subcortical_adjacency(connectivity, voxel_info)
+    key = ('whole_brain', id(sub))
+    if key not in _adjacency_cache:
+        assert cortical_adjacency.shape[0] == voxel_info.offset, 'cortical_adjacency does not match voxel_info'
+        _adjacency_cache[key] = block_diag((cortical_adjacency, sub), format='csr')
+    return _adjacency_cache[key]
+
+@instrumented
+def whole_brain_components(conditions, cutoff=0, connectivity=26, adjacency=None, n_jobs=None, chunk_size=None):
+    """
+    Decomposes boolean arrays of grayordinates into connected components on the whole brain graph
+    (see `whole_brain_adjacency`), including the subcortical voxels.
+    `conditions` is a single 1D condition or a 2D stack of conditions, which are labelled together in chunks
+    of `chunk_size` maps (by `n_jobs` threads, see `hcp_utils.parallel`).
+    A different grayordinate graph can be passed as `adjacency`.
+    Returns `n_components`, `sizes` and an integer array `rois` with corresponding labels like `cortical_components`
+    (for a stack: an array of `n_components`, a list of `sizes` and a 2D array `rois`).
+    0 means unassigned.
+    """
+    if adjacency is None:
+        adjacency = whole_brain_adjacency(connectivity)
+    conditions = np.asarray(conditions, dtype=bool)
+    single = conditions.ndim == 1
+    conditions = np.atleast_2d(conditions)
+    n_maps, n = conditions.shape
+    A = adjacency.tocoo()
+
+    n_components = np.zeros(n_maps, dtype=np.int64)
+    sizes = [None] * n_maps
+    rois = np.zeros((n_maps, n), dtype=np.int32)
+    def work(c):
+        n_components[c], sizes[c], rois[c] = _label_components(conditions[c], A, cutoff)
+    # the temporaries of a map take a few bytes per edge
+    run_chunks(work, n_maps, 4 * A.nnz, n_jobs, chunk_size)
+
+    if single:
+        return n_components[0], sizes[0], rois[0]
+    return n_components, sizes, rois
+
+def _label_components(conditions, A, cutoff):
+    n_maps, n = conditions.shape
+
+    # one block diagonal graph of the selected grayordinates of all maps
+    m, e = np.nonzero(conditions[:, A.row] & conditions[:, A.col])
+    map_index, node = np.nonzero(conditions)
+    position = -np.ones((n_maps, n), dtype=np.int64)
+    position[map_index, node] = np.arange(len(node))
+    G = csr_matrix((np.ones(len(e), dtype=np.int8), (position[m, A.row[e]], position[m, A.col[e]])), shape=(len(node), len(node)))
+    del position, m, e
+    _, labels = connected_components(G, directed=False)
+
+    # relabel the components of each map by decreasing size
+    counts = np.bincount(labels)
+    component_map = np.zeros(len(counts), dtype=np.int64)
+    component_map[labels] = map_index
+    order = np.lexsort((-counts, component_map))
+    n_components = np.bincount(component_map, minlength=n_maps)
+    first = np.cumsum(n_components) - n_components
+    rank = np.empty(len(counts), dtype=np.int64)
+    rank[order] = np.arange(len(counts)) - first[component_map[order]] + 1
+    sizes_all = counts[order]
+
+    rois = np.zeros((n_maps, n), dtype=np.int32)
+    rois[map_index, node] = rank[labels]
+    sizes = [sizes_all[first[i]:first[i] + n_components[i]] for i in range(n_maps)]
+
+    if cutoff>0:
+        for i in range(n_maps):
+            small = np.where(sizes[i]<cutoff)[0]
+            if len(small)>0:
+                maxc = small[0]
+                n_components[i] = maxc
+                sizes[i] = sizes[i][:maxc]
+                rois[i][rois[i]>maxc] = 0
+
+    return n_components, sizes, rois
 
+# local maxima and watershed segmentation of maps on a grayordinate graph
+#
+# The values of each map are replaced by their ranks (ties broken by the index), so that every
+# plateau has a single maximum. A maximum over the closed neighbourhood of all vertices is then
+# a single `reduceat` over the sparse adjacency structure, done for a chunk of maps at once.
+# The watershed follows the steepest ascent from each vertex (to its highest neighbour)
+# by pointer jumping, which labels the whole basin of each peak in O(log N) vectorized steps.
+
+def _closed_neighbourhood(adjacency):
+    A = csr_matrix(adjacency, dtype=bool)
+    A = (A + csr_matrix((np.ones(A.shape[0], dtype=bool), (np.arange(A.shape[0]), np.arange(A.shape[0]))), shape=A.shape)).tocsr()
+    A.sort_indices()
+    return A
+
+def _neighbourhood_min(R, A):
+    # minimal rank (i.e. the highest value) in the closed neighbourhood of each vertex
+    return np.minimum.reduceat(R[:, A.indices], A.indptr[:-1], axis=1)
+
+def _ascend(V, A, threshold, min_distance, segment):
+    m, n = V.shape
+    above = ~np.isnan(V)
+    if threshold is not None:
+        above &= V > threshold
+    order = np.argsort(np.where(above, -V, np.inf), axis=1, kind='stable').astype(np.int32)
+    R = np.empty_like(order)
+    np.put_along_axis(R, order, np.arange(n, dtype=np.int32)[np.newaxis, :], axis=1)
+    R[~above] = n
+
+    R1 = _neighbourhood_min(R, A)
+    # distances are measured along paths above threshold: the vertices below it do not pass the maxima on
+    Rd = np.where(above, R1, n)
+    for _ in range(min_distance - 1):
+        Rd = _neighbourhood_min(Rd, A)
+        Rd[~above] = n
+    peaks = above & (Rd == R)
+    if not segment:
+        return peaks, R, None
+
+    # each vertex points to its highest neighbour, pruned maxima to the highest vertex within min_distance
+    # (which lies in the same cluster above threshold)
+    rows = np.arange(m)[:, np.newaxis]
+    parent = np.where(above, order[rows, np.minimum(R1, n - 1)], np.arange(n, dtype=np.int32))
+    pruned = above & (R1 == R) & ~peaks
+    parent[pruned] = order[rows, np.minimum(Rd, n - 1)][pruned]
+    while True:
+        grandparent = np.take_along_axis(parent, parent, axis=1)
+        if np.array_equal(grandparent, parent):
+            break
+        parent = grandparent
+
+    # peaks are numbered by decreasing value
+    sorted_peaks = np.take_along_axis(peaks, order, axis=1)
+    numbers = np.empty((m, n), dtype=np.int32)
+    np.put_along_axis(numbers, order, (np.cumsum(sorted_peaks, axis=1) * sorted_peaks).astype(np.int32), axis=1)
+    labels = np.take_along_axis(numbers, parent, axis=1) * above
+    return peaks, R, labels
+
+def _peak_search(maps, threshold, min_distance, adjacency, segment, n_jobs, chunk_size):
+    assert min_distance >= 1, 'min_distance should be at least 1'
+    maps = np.asarray(maps, dtype=np.float64)
+    single = maps.ndim == 1
+    maps = np.atleast_2d(maps)
+    if adjacency is None:
+        adjacency = cortical_adjacency
+    if adjacency.shape[0] == struct.cortex.stop and maps.shape[1] > struct.cortex.stop:
+        # a cortical graph with whole brain maps
+        region = struct.cortex
+    else:
+        region = slice(0, maps.shape[1])
+    V = maps[:, region]
+    assert adjacency.shape == (V.shape[1], V.shape[1]), 'adjacency does not match the size of the maps'
+    A = _closed_neighbourhood(adjacency)
+
+    peaks = np.zeros(V.shape, dtype=bool)
+    ranks = np.zeros(V.shape, dtype=np.int32)
+    labels = np.zeros(V.shape, dtype=np.int32) if segment else None
+    def work(c):
+        p, r, l = _ascend(V[c], A, threshold, min_distance, segment)
+        peaks[c] = p
+        ranks[c] = r
+        if segment:
+            labels[c] = l
+    run_chunks(work, len(V), A.nnz * 4, n_jobs, chunk_size)
+
+    # grayordinate indices of the peaks of each map, by decreasing value
+    peak_indices = []
+    for i in range(len(V)):
+        p = np.where(peaks[i])[0]
+        peak_indices.append(region.start + p[np.argsort(ranks[i, p])])
+    return single, maps, region, peak_indices, labels
+
+@instrumented
+def local_maxima(maps, threshold=None, min_distance=1, adjacency=None, n_jobs=None, chunk_size=None):
+    """
+    Finds the local maxima (peaks) of a map (1D) or a stack of maps (2D) on the cortical surface, or on the grayordinate
+    graph `adjacency` (e.g. `whole_brain_adjacency()`; a cortical graph uses only the cortex of whole brain maps). Only values above `threshold` are considered.
+    A peak is the highest vertex within `min_distance` edges along paths above threshold, so the peaks of a cluster
+    are separated by more than `min_distance` edges within the cluster (peaks of different clusters are always kept).
+    The maps are processed in chunks by `n_jobs` threads (see `hcp_utils.parallel`).
+    Returns the grayordinate indices of the peaks sorted by decreasing value (for a stack: a list of such arrays).
+    """
+    single, _, _, peak_indices, _ = _peak_search(maps, threshold, min_distance, adjacency, False, n_jobs, chunk_size)
+    if single:
+        return peak_indices[0]
+    return peak_indices
+
+def _peak_parcellation(map_all, peaks, values):
+    cmap = plt.get_cmap('tab20')
+    ids = np.arange(len(peaks) + 1)
+    colors = cmap(np.arange(len(peaks)) % cmap.N)
+    parcellation = Bunch()
+    parcellation.ids = ids
+    parcellation.nontrivial_ids = ids[1:]
+    parcellation.map_all = map_all
+    parcellation.labels = {0: ''}
+    parcellation.labels.update((k, 'peak {}'.format(k)) for k in range(1, len(ids)))
+    parcellation.rgba = {0: np.array([1.0, 1.0, 1.0, 1.0])}
+    parcellation.rgba.update(zip(range(1, len(ids)), colors))
+    parcellation.peaks = peaks
+    parcellation.peak_values = values
+    return parcellation
 
+@instrumented
+def watershed_parcellation(maps, threshold=None, min_distance=1, adjacency=None, n_jobs=None, chunk_size=None):
+    """
+    Segments a map (1D) or a stack of maps (2D) above `threshold` into the basins of its peaks (see `local_maxima`)
+    on the cortical surface, or on the grayordinate graph `adjacency`. Every vertex is assigned to the peak
+    reached by the steepest ascent from it, the basins of peaks pruned by `min_distance` join the basin of the
+    higher peak nearby.
+    Returns a parcellation (for a stack: a list of parcellations) usable with `parcellate` and `view_parcellation`,
+    with parcel k (numbered by decreasing peak value) containing the basin of peak `peaks[k-1]` of value `peak_values[k-1]`.
+    """
+    single, maps, region, peak_indices, labels = _peak_search(maps, threshold, min_distance, adjacency, True, n_jobs, chunk_size)
+    parcellations = []
+    for i in range(len(maps)):
+        map_all = np.zeros(maps.shape[1], dtype=int)
+        map_all[region] = labels[i]
+        parcellations.append(_peak_parcellation(map_all, peak_indices[i], maps[i, peak_indices[i]]))
+    if single:
+        return parcellations[0]
+    return parcellations
@@ -0,0 +1,118 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+# Chunked execution of the array-level functions on a shared thread pool.
+#
+# NumPy releases the GIL in its inner loops, so chunks of rows (time frames) or columns
+# (grayordinates) can be processed concurrently by threads writing into a preallocated output.
+# Each chunk is computed exactly as in the serial code, so that the results are bit-identical.
+
+# The chunk size of a call is given in the units of that function (time frames, grayordinates or maps),
+# while the global setting `chunk_bytes` is a target size of the chunks, which is valid for all functions.
+
+_config = {'n_jobs': 1, 'chunk_bytes': None}
+
+# default target size of a chunk of the input, small enough to stay in cache
+CHUNK_BYTES = 4 * 2**20
+
+_pool = None
+_pool_size = 0
+_pool_lock = threading.Lock()
+
+
+def get_config():
+    """
+    Returns the global defaults of `n_jobs` and `chunk_bytes`.
+    """
+    return dict(_config)
+
+
+def set_config(n_jobs=None, chunk_bytes=None):
+    """
+    Sets the global default of `n_jobs` (-1 means all cores) used when it is not given explicitly to `parcellate`,
+    `unparcellate`, `normalize`, `cortex_data`, `mask`, `whole_brain_components`, `local_maxima` or
+    `watershed_parcellation`, and the target size `chunk_bytes` of the chunks when no `chunk_size` is given
+    (setting it enables chunking also with a single thread).
+    """
+    if n_jobs is not None:
+        _check_n_jobs(n_jobs)
+        _config['n_jobs'] = n_jobs
+    if chunk_bytes is not None:
+        assert chunk_bytes > 0, 'chunk_bytes should be positive'
+        _config['chunk_bytes'] = chunk_bytes
+
+
+@contextmanager
+def config(n_jobs=None, chunk_bytes=None):
+    """
+    Context manager setting `n_jobs` and `chunk_bytes` within a block of code, e.g.
+
+    ```
+    with hcp.parallel.config(n_jobs=16):
+        Xn = hcp.normalize(X)
+        Xp = hcp.parcellate(Xn, hcp.mmp)
+    ```
+    """
+    previous = get_config()
+    set_config(n_jobs, chunk_bytes)
+    try:
+        yield
+    finally:
+        _config.update(previous)
+
+
+def _check_n_jobs(n_jobs):
+    if n_jobs == 0:
+        raise ValueError('n_jobs should be a positive number of threads or negative (-1 means all cores), not 0')
+
+
+def _n_jobs(n_jobs):
+    if n_jobs is None:
+        n_jobs = _config['n_jobs']
+    _check_n_jobs(n_jobs)
+    if n_jobs < 0:
+        n_jobs = max(1, (os.cpu_count() or 1) + 1 + n_jobs)
+    return n_jobs
+
+
+def _get_pool(n_jobs):
+    global _pool, _pool_size
+    with _pool_lock:
+        if _pool is None or _pool_size < n_jobs:
+            if _pool is not None:
+                _pool.shutdown(wait=True)
+            _pool = ThreadPoolExecutor(max_workers=n_jobs, thread_name_prefix='hcp_utils')
+            _pool_size = n_jobs
+        return _pool
+
+
+def is_serial(n_jobs=None, chunk_size=None):
+    """
+    True if neither parallel execution nor chunking was requested.
+    """
+    return _n_jobs(n_jobs) == 1 and chunk_size is None and _config['chunk_bytes'] is None
+
+
+def run_chunks(fn, n, item_bytes, n_jobs=None, chunk_size=None):
+    """
+    Calls `fn(slice)` for consecutive chunks of `range(n)` on the shared thread pool.
+    Without `chunk_size` the chunks of items of `item_bytes` bytes each take about `chunk_bytes` (see `set_config`),
+    by default `CHUNK_BYTES`.
+    """
+    n_jobs = _n_jobs(n_jobs)
+    if chunk_size is None:
+        chunk_bytes = _config['chunk_bytes'] or CHUNK_BYTES
+        chunk_size = max(1, chunk_bytes // max(1, int(item_bytes)))
+    assert chunk_size >= 1, 'chunk_size should be at least 1'
+    chunks = [slice(i, min(i + chunk_size, n)) for i in range(0, n, chunk_size)]
+
+    if n_jobs == 1 or len(chunks) == 1:
+        for c in chunks:
+            fn(c)
+        return
+    pool = _get_pool(n_jobs)
+    # consume the results to propagate exceptions
+    for _ in pool.map(fn, chunks):
+        pass
@@ -0,0 +1,229 @@
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+# Opt-in instrumentation of the main entry points of hcp_utils.
+#
+# Instrumented functions record the wall time, shapes and dtypes of their array arguments and
+# (optionally) the peak of memory allocated during the call. Caches report hits and misses.
+# When disabled, an instrumented function costs one check of a module flag.
+#
+# Enable for the whole process with `enable()` or by setting the environment variable HCP_UTILS_PROFILE
+# before importing hcp_utils, or for a block of code with the context manager `profile()`, which collects
+# its own records without touching the process-wide ones. HCP_UTILS_PROFILE=1 just enables the recording,
+# any other value (except 0) is taken as a filename to which each record is appended as a JSON line
+# as soon as it is made (instead of being kept in memory).
+
+_enabled = False
+_track_memory = False
+# nesting depth of the instrumented calls, per thread
+_local = threading.local()
+# guards the output file and the cache counts against concurrent callers
+_lock = threading.Lock()
+_started_tracing = False
+_stream = None
+
+records = []
+cache_counts = dict()
+
+# records and cache counts of the active `profile()` blocks
+_blocks = []
+
+
+class ProfileBlock(list):
+    """
+    The records of a `profile()` block, with its cache counts in `cache_counts`.
+    """
+    def __init__(self, track_memory=False):
+        super().__init__()
+        self.cache_counts = dict()
+        self.track_memory = track_memory
+
+
+def _describe(x):
+    if isinstance(x, np.ndarray):
+        return {'shape': list(x.shape), 'dtype': str(x.dtype)}
+    return None
+
+
+def _call(name, fn, args, kwargs):
+    global _started_tracing
+    depth = getattr(_local, 'depth', 0)
+    inputs = [d for d in map(_describe, list(args) + list(kwargs.values())) if d is not None]
+    # memory is measured only for the outermost instrumented call, as nested calls would reset the peak
+    measure_memory = (_track_memory or any(block.track_memory for block in _blocks)) and depth == 0
+    if measure_memory:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _started_tracing = True
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        else:
+            tracemalloc.clear_traces()
+        before = tracemalloc.get_traced_memory()[0]
+
+    _local.depth = depth + 1
+    start = time.perf_counter()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        elapsed = time.perf_counter() - start
+        _local.depth = depth
+        record = {'function': name, 'time': elapsed, 'inputs': inputs, 'depth': depth}
+        if measure_memory:
+            record['allocated'] = tracemalloc.get_traced_memory()[1] - before
+        _add_record(record)
+
+
+def _add_record(record):
+    if _enabled:
+        if _stream is not None:
+            line = json.dumps(record) + '\n'
+            with _lock:
+                _stream.write(line)
+        else:
+            records.append(record)
+    for block in _blocks:
+        block.append(record)
+
+
+def _count(counts, cache, hit):
+    with _lock:
+        c = counts.setdefault(cache, {'hits': 0, 'misses': 0})
+        c['hits' if hit else 'misses'] += 1
+
+
+def instrumented(fn):
+    """
+    Decorator making `fn` report into the profiling records when profiling is enabled.
+    """
+    name = fn.__name__
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not _enabled and not _blocks:
+            return fn(*args, **kwargs)
+        return _call(name, fn, args, kwargs)
+    return wrapper
+
+
+def cache_event(cache, hit):
+    """
+    Records a hit (or a miss) of the cache named `cache`.
+    """
+    if _enabled:
+        _count(cache_counts, cache, hit)
+    for block in _blocks:
+        _count(block.cache_counts, cache, hit)
+
+
+def enable(track_memory=False):
+    """
+    Starts the process-wide recording. With `track_memory=True` the memory allocated during each call is traced
+    with `tracemalloc`, which slows down the computations.
+    """
+    global _enabled, _track_memory
+    _enabled = True
+    _track_memory = track_memory
+
+
+def disable():
+    """
+    Stops the process-wide recording (the records are kept).
+    """
+    global _enabled, _track_memory, _started_tracing
+    _enabled = False
+    if _started_tracing and not _blocks:
+        tracemalloc.stop()
+        _started_tracing = False
+    _track_memory = False
+
+
+def reset():
+    """
+    Clears the process-wide records and cache counts.
+    """
+    del records[:]
+    cache_counts.clear()
+
+
+@contextmanager
+def profile(track_memory=False):
+    """
+    Context manager recording the calls of instrumented functions inside the block, e.g.
+
+    ```
+    with hcp.profiling.profile() as block:
+        Xp = hcp.parcellate(X, hcp.mmp)
+    hcp.profiling.summary(block)
+    ```
+    The block gets its own records (a `ProfileBlock`), the process-wide records are kept as they are.
+    """
+    global _started_tracing
+    block = ProfileBlock(track_memory)
+    _blocks.append(block)
+    try:
+        yield block
+    finally:
+        _blocks.remove(block)
+        if _started_tracing and not _blocks and not _track_memory:
+            tracemalloc.stop()
+            _started_tracing = False
+
+
+def summary(block=None):
+    """
+    Returns a dataframe with the number of calls and the total, mean and maximal time of each instrumented function,
+    sorted by the total time, followed by the cache statistics. Summarizes the records of a `profile()` block
+    if given, otherwise the process-wide records.
+    """
+    if block is None:
+        block_records, counts = records, cache_counts
+    else:
+        block_records, counts = block, block.cache_counts
+    df = pd.DataFrame(block_records, columns=['function', 'time', 'allocated'])
+    table = df.groupby('function').agg(calls=('time', 'size'), total_time=('time', 'sum'),
+                                       mean_time=('time', 'mean'), max_time=('time', 'max'),
+                                       max_allocated=('allocated', 'max'))
+    table = table.sort_values('total_time', ascending=False)
+    for cache, c in counts.items():
+        table.loc['cache:' + cache, ['calls']] = c['hits'] + c['misses']
+        table.loc['cache:' + cache, 'hits'] = c['hits']
+        table.loc['cache:' + cache, 'misses'] = c['misses']
+    return table
+
+
+def write_jsonl(filename):
+    """
+    Appends the records (and the cache counts) as JSON lines to `filename`.
+    """
+    with open(filename, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+        for cache, counts in cache_counts.items():
+            f.write(json.dumps(dict(cache=cache, **counts)) + '\n')
+
+
+def _close_stream():
+    global _stream
+    for cache, counts in cache_counts.items():
+        _stream.write(json.dumps(dict(cache=cache, **counts)) + '\n')
+    _stream.close()
+    _stream = None
+
+
+_env = os.environ.get('HCP_UTILS_PROFILE', '0')
+if _env != '0':
+    enable()
+    if _env != '1':
+        # line buffered, so that the records survive a crash of the job
+        _stream = open(_env, 'a', buffering=1)
+        atexit.register(_close_stream)
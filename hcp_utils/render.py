@@ -0,0 +1,280 @@
+import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import PolyCollection
+from matplotlib.image import imsave
+import numpy as np
+from sklearn.utils import Bunch
+from scipy.sparse import csr_matrix
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
+import time
+
+from .hcp_utils import mesh, vertex_info, _parcel_index
+from .profiling import instrumented, cache_event
+
+# Headless batch rendering of many grayordinate maps to static PNG images.
+#
+# Everything which depends only on the mesh and the views is computed once: the sparse
+# matrix interpolating grayordinate values onto the mesh faces, the orthographic projection
+# of the faces, back-face culling, the painter's order and the shading. The visible faces are
+# then rasterized once into an image of face indices, so that rendering a map reduces to
+# looking up the colours of the faces at each pixel and encoding the PNG.
+
+# view name: (direction towards the camera, up direction, hemisphere)
+_VIEWS = {
+    'lateral_left': ((-1, 0, 0), (0, 0, 1), 'left'),
+    'medial_left': ((1, 0, 0), (0, 0, 1), 'left'),
+    'lateral_right': ((1, 0, 0), (0, 0, 1), 'right'),
+    'medial_right': ((-1, 0, 0), (0, 0, 1), 'right'),
+    'dorsal': ((0, 0, 1), (0, 1, 0), 'both'),
+    'ventral': ((0, 0, -1), (0, 1, 0), 'both'),
+    'anterior': ((0, 1, 0), (0, 0, 1), 'both'),
+    'posterior': ((0, -1, 0), (0, 0, 1), 'both'),
+    'flat': ((1, 0, 0), (0, 0, 1), 'both'),
+}
+
+# prepared states of the most recently used meshes and views
+_render_cache = OrderedDict()
+RENDER_CACHE_SIZE = 4
+
+
+def _face_interpolation(faces, n_vertices, vertex_info):
+    """
+    Sparse `n_faces x n_cortex` matrix averaging the cortical grayordinates at the corners of each face.
+    Faces without any grayordinate (the medial wall) get an empty row.
+    """
+    gray_of_vertex = -np.ones(n_vertices, dtype=int)
+    gray_of_vertex[vertex_info.grayl] = np.arange(len(vertex_info.grayl))
+    gray_of_vertex[vertex_info.num_meshl + vertex_info.grayr] = len(vertex_info.grayl) + np.arange(len(vertex_info.grayr))
+    n_cortex = len(vertex_info.grayl) + len(vertex_info.grayr)
+
+    corners = gray_of_vertex[faces]
+    valid = corners >= 0
+    n_valid = valid.sum(axis=1)
+    rows = np.repeat(np.arange(len(faces)), 3).reshape(-1, 3)[valid]
+    with np.errstate(divide='ignore'):
+        weights = (1.0 / n_valid)[:, np.newaxis].repeat(3, axis=1)[valid]
+    F = csr_matrix((weights, (rows, corners[valid])), shape=(len(faces), n_cortex))
+    return F, n_valid > 0
+
+
+def _prepare_view(coord, faces, view, n_left):
+    direction, up, hemisphere = _VIEWS[view]
+    d = np.asarray(direction, dtype=np.float64)
+    up = np.asarray(up, dtype=np.float64)
+    right = np.cross(up, d)
+
+    if hemisphere == 'left':
+        selected = np.all(faces < n_left, axis=1)
+    elif hemisphere == 'right':
+        selected = np.all(faces >= n_left, axis=1)
+    else:
+        selected = np.ones(len(faces), dtype=bool)
+
+    v0 = coord[faces[:, 0]]
+    normals = np.cross(coord[faces[:, 1]] - v0, coord[faces[:, 2]] - v0)
+    normals /= np.maximum(np.linalg.norm(normals, axis=1), 1e-12)[:, np.newaxis]
+    facing = normals @ d
+    if view != 'flat':
+        selected &= facing > 0
+
+    face_ids = np.where(selected)[0]
+    depth = coord[faces[face_ids]].mean(axis=1) @ d
+    face_ids = face_ids[np.argsort(depth)]
+
+    xy = np.stack((coord @ right, coord @ up), axis=1)
+    v = Bunch()
+    v.face_ids = face_ids
+    v.polygons = xy[faces[face_ids]]
+    v.shading = 0.5 + 0.5 * np.abs(facing[face_ids])
+    v.xlim = (xy[faces[face_ids], 0].min(), xy[faces[face_ids], 0].max())
+    v.ylim = (xy[faces[face_ids], 1].min(), xy[faces[face_ids], 1].max())
+    return v
+
+
+def _rasterize_faces(views, figsize, dpi):
+    """
+    Draws the faces of all views side by side with colours encoding their (1-based) position
+    in the concatenated face lists and decodes the image into an array of indices (-1 for background).
+    """
+    # an Agg canvas not managed by pyplot, so that the interactive backend is left alone
+    fig = Figure(figsize=(figsize[0] * len(views), figsize[1]), dpi=dpi, facecolor='black')
+    canvas = FigureCanvasAgg(fig)
+    axes = fig.subplots(1, len(views), squeeze=False)
+    offset = 0
+    for ax, v in zip(axes[0], views):
+        codes = offset + np.arange(len(v.face_ids)) + 1
+        colors = np.stack(((codes >> 16) & 255, (codes >> 8) & 255, codes & 255, np.full_like(codes, 255)), axis=1) / 255.0
+        ax.add_collection(PolyCollection(v.polygons, facecolors=colors, edgecolors='none', linewidths=0, antialiaseds=False))
+        ax.set_xlim(*v.xlim)
+        ax.set_ylim(*v.ylim)
+        ax.set_aspect('equal')
+        ax.set_axis_off()
+        offset += len(v.face_ids)
+    fig.subplots_adjust(left=0, right=1, top=1, bottom=0, wspace=0)
+    canvas.draw()
+    rgb = np.asarray(canvas.buffer_rgba())[:, :, :3].astype(np.int64)
+    return (rgb[:, :, 0] << 16) + (rgb[:, :, 1] << 8) + rgb[:, :, 2] - 1
+
+
+def prepare_rendering(meshLR=None, views=('lateral_left', 'lateral_right'), bg_map=None,
+                      figsize=(4, 3), dpi=100, vertex_info=vertex_info):
+    """
+    Precomputes (and caches, for the `RENDER_CACHE_SIZE` most recently used settings) everything needed by `render_maps` for a given mesh, list of views and image size.
+    `meshLR` is a whole brain mesh or the name of a variant of `mesh` (by default `'inflated'`).
+    `bg_map` gives the background shading of the mesh vertices (`mesh.sulc` by default for the preloaded meshes).
+    Available views: lateral_left, medial_left, lateral_right, medial_right, dorsal, ventral, anterior, posterior, flat.
+    """
+    if meshLR is None:
+        meshLR = 'inflated'
+    if isinstance(meshLR, str):
+        if bg_map is None:
+            bg_map = mesh.sulc
+        meshLR = mesh[meshLR]
+    coord, faces = meshLR
+    views = tuple(views)
+    for view in views:
+        if view not in _VIEWS:
+            raise ValueError('view should be one of ' + ','.join(_VIEWS))
+
+    key = (id(coord), views, id(bg_map), tuple(figsize), dpi, id(vertex_info))
+    cached = _render_cache.get(key)
+    # the ids can be reused by new objects once the old ones are freed, hence the identity checks
+    if cached is not None and cached.coord is coord and cached.bg_map is bg_map and cached.vertex_info is vertex_info:
+        cache_event('prepare_rendering', hit=True)
+        _render_cache.move_to_end(key)
+        return cached
+    cache_event('prepare_rendering', hit=False)
+
+    prepared = [_prepare_view(coord, faces, view, vertex_info.num_meshl) for view in views]
+    face_ids = np.hstack([v.face_ids for v in prepared])
+    F, covered = _face_interpolation(faces, len(coord), vertex_info)
+    if bg_map is not None:
+        bg_faces = np.asarray(bg_map)[faces].mean(axis=1)
+        bg = 0.5 + 0.15 * np.tanh(bg_faces / (np.std(bg_faces) + 1e-12))
+    else:
+        bg = np.full(len(faces), 0.6)
+
+    # only the visible faces of each view (in the order of the rasterized face indices) are kept
+    state = Bunch()
+    state.coord = coord
+    state.bg_map = bg_map
+    state.vertex_info = vertex_info
+    state.F = F[face_ids]
+    state.covered = covered[face_ids]
+    state.bg = bg[face_ids]
+    state.shading = np.hstack([v.shading for v in prepared])
+    state.pixels = _rasterize_faces(prepared, figsize, dpi)
+    _render_cache[key] = state
+    _render_cache.move_to_end(key)
+    while len(_render_cache) > RENDER_CACHE_SIZE:
+        _render_cache.popitem(last=False)
+    return state
+
+
+def _face_colors(values, bg, lut, vmin, vmax, threshold):
+    if vmax is None:
+        m = np.nanmax(np.abs(values)) if np.any(np.isfinite(values)) else 1.0
+        lo, hi = -m, m
+    else:
+        lo, hi = (-vmax if vmin is None else vmin), vmax
+    with np.errstate(invalid='ignore'):
+        idx = np.clip(((values - lo) / max(hi - lo, 1e-12) * 255).astype(np.int64, copy=False), 0, 255)
+    colors = lut[idx]
+    background = ~np.isfinite(values)
+    if threshold is not None:
+        with np.errstate(invalid='ignore'):
+            background |= np.abs(values) < threshold
+    colors[background, :3] = bg[background, np.newaxis]
+    colors[:, 3] = 1.0
+    return colors
+
+
+# per process state of the rendering workers
+
+_worker = Bunch()
+
+
+def _worker_init(pixels, bg, shading, lut):
+    _worker.pixels = pixels
+    _worker.bg = bg
+    _worker.shading = shading
+    _worker.lut = lut
+
+
+def _render_chunk(face_values, filenames, vmin, vmax, threshold):
+    background = _worker.pixels < 0
+    for values, filename in zip(face_values, filenames):
+        colors = _face_colors(values, _worker.bg, _worker.lut, vmin, vmax, threshold)
+        colors[:, :3] *= _worker.shading[:, np.newaxis]
+        image = (colors[_worker.pixels, :3] * 255).astype(np.uint8)
+        image[background] = 255
+        # fast zlib level - QC images are written once and rarely kept for long
+        imsave(filename, image, pil_kwargs={'compress_level': 1})
+    return len(filenames)
+
+
+@instrumented
+def render_maps(maps, filenames, meshLR=None, parcellation=None, views=('lateral_left', 'lateral_right'),
+                cmap='cold_hot', vmin=None, vmax=None, threshold=None, bg_map=None,
+                figsize=(4, 3), dpi=100, n_jobs=1, chunk_size=16, vertex_info=vertex_info):
+    """
+    Renders a stack of maps to static PNG images without an interactive viewer.
+
+    `maps` is either an `n x 91282` stack of grayordinate maps (only the cortex is shown) or, if `parcellation`
+    is given, an `n x K` stack of parcellated maps. `filenames` is a list of output files or a pattern like
+    `'qc/sub-{:04d}.png'` formatted with the index of the map. The maps are rendered on the views `views`
+    (placed side by side) of the whole brain mesh `meshLR` (a variant name of `mesh` or a mesh, `'inflated'` by default).
+
+    The colour scale is `[vmin, vmax]` if given, otherwise symmetric with the maximal absolute value of each map.
+    Values with absolute value below `threshold` show the background (`bg_map`, by default the sulcal depth).
+    With `n_jobs>1` the images are produced in a pool of processes.
+
+    Returns a Bunch with the `filenames`, `n_maps`, `seconds` and the throughput `maps_per_second`.
+    """
+    start = time.time()
+    state = prepare_rendering(meshLR, views, bg_map, figsize, dpi, vertex_info)
+
+    maps = np.atleast_2d(np.asarray(maps, dtype=np.float64))
+    if parcellation is not None:
+        index = _parcel_index(parcellation)[:state.F.shape[1]]
+        P = csr_matrix((np.ones(np.count_nonzero(index >= 0)), (np.where(index >= 0)[0], index[index >= 0])),
+                       shape=(state.F.shape[1], len(parcellation.nontrivial_ids)))
+        F = (state.F @ P).tocsr()
+        # renormalize faces with some corners outside of the parcellation
+        totals = np.asarray(F.sum(axis=1)).ravel()
+        covered = totals > 0
+        F = csr_matrix(F.multiply(1.0 / np.where(covered, totals, 1.0)[:, np.newaxis]))
+    else:
+        F = state.F
+        maps = maps[:, :F.shape[1]]
+        covered = state.covered
+    face_values = (F @ maps.T).T.astype(np.float32)
+    face_values[:, ~covered] = np.nan
+
+    if isinstance(filenames, str):
+        filenames = [filenames.format(i) for i in range(len(maps))]
+    assert len(filenames) == len(maps), 'number of filenames and maps differ'
+
+    if cmap == 'cold_hot':
+        from nilearn.plotting.cm import cold_hot
+        cmap = cold_hot
+    init_args = (state.pixels, state.bg, state.shading, plt.get_cmap(cmap)(np.linspace(0, 1, 256)))
+    chunks = [slice(i, i + chunk_size) for i in range(0, len(maps), chunk_size)]
+    if n_jobs == 1:
+        _worker_init(*init_args)
+        for c in chunks:
+            _render_chunk(face_values[c], filenames[c], vmin, vmax, threshold)
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_worker_init, initargs=init_args) as pool:
+            futures = [pool.submit(_render_chunk, face_values[c], filenames[c], vmin, vmax, threshold) for c in chunks]
+            for f in futures:
+                f.result()
+
+    result = Bunch()
+    result.filenames = filenames
+    result.n_maps = len(maps)
+    result.seconds = time.time() - start
+    result.maps_per_second = result.n_maps / result.seconds
+    return result
@@ -0,0 +1,25 @@
+import nibabel as nib
+import numpy as np
+
+# voxel indices of the subcortical grayordinates of standard 3T HCP data (2mm MNI volume)
+# used for the subcortical voxel adjacency
+
+img = nib.load('../source_data/CortexSubcortex_ColeAnticevic_NetPartition_wSubcorGSR_parcels_LR.dlabel.nii')
+
+map1 = img.header.get_index_map(1)
+
+ijk = []
+offset = None
+for bm in map1.brain_models:
+    if bm.model_type == 'CIFTI_MODEL_TYPE_VOXELS':
+        if offset is None:
+            offset = bm.index_offset
+        ijk.append(np.array(bm.voxel_indices_ijk))
+
+ijk = np.vstack(ijk)
+dims = np.array(map1.volume.volume_dimensions)
+affine = map1.volume.transformation_matrix_voxel_indices_ijk_to_xyz.matrix
+
+print(offset, ijk.shape, dims)   # 59412 (31870, 3) [ 91 109  91]
+
+np.savez_compressed('../hcp_utils/data/fMRI_voxel_info_2mm.npz', ijk=ijk.astype(np.int16), offset=offset, dims=dims, affine=affine)